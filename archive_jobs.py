@@ -0,0 +1,325 @@
+from load_tagcam import load_directory, load_files
+from find_hot_pixels import find_hps
+from find_streaks import find_streaks
+from stray_light import corner_means, parse_time
+import os
+import json
+import time
+import socket
+import numpy as np
+from multiprocessing import Pool
+
+__doc__ = """
+Run an analysis over a large image archive in shards so that it can be spread over worker processes and resumed after
+a failure. A job lives in a directory:
+
+    job.json            the task, its parameters and the list of files in every shard
+    shard_<n>.npz       the result of each completed shard (the checkpoint)
+    shard_<n>.lock      a shard that a worker is currently processing
+    shard_<n>.error     the error message of a shard that failed
+
+Workers claim a shard by creating its lock file, so several machines sharing the job directory over a shared
+filesystem can run the same job at once. The locks of dead workers are taken over by atomically renaming them aside.
+Rerunning a job skips every shard that already has a result. Once every shard is complete the partial results are
+merged: the hot pixel candidate masks are AND-ed together and the streak and stray light tables are concatenated.
+"""
+
+
+def hot_pixel_shard(images, file_names, sigma=4):
+    """Hot pixel candidates of a shard as a boolean mask"""
+    mask = np.zeros(images[0].shape, dtype=bool)
+
+    candidates = find_hps(images, sigma)
+    if candidates:
+        mask[tuple(np.array(candidates).T)] = True
+
+    return {'mask': mask}
+
+
+def merge_hot_pixels(results):
+    """A hot pixel has to be active in every image, so it has to be a candidate in every shard"""
+    mask = np.logical_and.reduce([result['mask'] for result in results])
+    return [tuple(c) for c in np.argwhere(mask)]
+
+
+def streak_shard(images, file_names, method='hough'):
+    """Streak count of every image in a shard"""
+    return {'file': np.array(file_names),
+            'streak_count': np.array([find_streaks(im, method=method) for im in images])}
+
+
+def stray_light_shard(images, file_names, size=31):
+    """Average DN value in each corner of every image in a shard"""
+    corners = ('top_left', 'top_right', 'bottom_left', 'bottom_right')
+    table = {'file': np.array(file_names), 'time': [], **{corner: [] for corner in corners}}
+
+    for im in images:
+        table['time'].append(parse_time(im.obsdate))
+
+        # Correct orientation. Raw read function returns the image flipped
+        for corner, mean in zip(corners, corner_means(np.fliplr(im), size=size)):
+            table[corner].append(mean)
+
+    table['time'] = np.array(table['time'], dtype='datetime64[ms]')
+    return {name: np.asarray(column) for name, column in table.items()}
+
+
+def concatenate_tables(results):
+    """Join tables (dictionaries of columns) column by column"""
+    return {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+
+# Each task processes the images of a shard into a dictionary of arrays and merges the shard results
+TASKS = {
+    'hot_pixels': (hot_pixel_shard, merge_hot_pixels),
+    'streaks': (streak_shard, concatenate_tables),
+    'stray_light': (stray_light_shard, concatenate_tables)
+}
+
+
+def shard_path(job_dir, shard, extension):
+    return os.path.join(job_dir, "shard_{0}.{1}".format(shard, extension))
+
+
+def create_job(directories, job_dir, task, shard_size=50, **kwargs):
+    """ Split the raw files in the directories into shards and save the job definition
+
+    :param directories: The locations of the raw files
+    :param job_dir: Where the job definition and checkpoints are kept
+    :param task: Name of the analysis to run. One of TASKS
+    :param shard_size: Number of images per shard
+    :param kwargs: Parameters passed to the task function
+    :return: The number of shards
+    """
+    if task not in TASKS:
+        raise ValueError("Unknown task '{0}'. Choose from {1}".format(task, sorted(TASKS)))
+
+    if os.path.exists(os.path.join(job_dir, 'job.json')):
+        raise ValueError("A job already exists in {0}".format(job_dir))
+
+    file_names = []
+    for directory in directories:
+        file_names.extend(sorted(load_directory(directory)))
+
+    if not file_names:
+        raise ValueError("No raw files found in {0}".format(directories))
+
+    shards = [file_names[i:i + shard_size] for i in range(0, len(file_names), shard_size)]
+
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+
+    with open(os.path.join(job_dir, 'job.json'), 'w') as f:
+        json.dump({'task': task, 'kwargs': kwargs, 'shards': shards}, f, indent=1)
+
+    return len(shards)
+
+
+def load_job(job_dir):
+    with open(os.path.join(job_dir, 'job.json')) as f:
+        return json.load(f)
+
+
+def lock_owner():
+    """Identify this worker in its lock files"""
+    return "{0} {1}".format(socket.gethostname(), os.getpid())
+
+
+def claim(job_dir, shard, stale_after):
+    """ Try to take ownership of a shard by creating its lock file. Locks left behind by dead workers on this machine
+    or older than stale_after seconds are taken over
+
+    :return: True if this worker now owns the shard
+    """
+    lock = shard_path(job_dir, shard, 'lock')
+
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not stale_lock(lock, stale_after):
+            return False
+
+        # Several workers can find the same stale lock. Renaming is atomic, so only one of them gets to move it aside
+        taken = "{0}.{1}.{2}".format(lock, socket.gethostname(), os.getpid())
+        try:
+            os.rename(lock, taken)
+        except FileNotFoundError:
+            return False
+
+        # Another worker may have taken the stale lock over and made a fresh one just before the rename. Put it back
+        if not stale_lock(taken, stale_after):
+            try:
+                os.link(taken, lock)
+            except FileExistsError:
+                pass
+            os.remove(taken)
+            return False
+
+        os.remove(taken)
+        return claim(job_dir, shard, stale_after)
+
+    with os.fdopen(fd, 'w') as f:
+        f.write(lock_owner())
+
+    return True
+
+
+def release(job_dir, shard):
+    """Remove this worker's lock on a shard. The lock may already be gone or taken over by another worker"""
+    lock = shard_path(job_dir, shard, 'lock')
+
+    try:
+        with open(lock) as f:
+            owner = f.read()
+
+        if owner == lock_owner():
+            os.remove(lock)
+    except FileNotFoundError:
+        pass
+
+
+def stale_lock(lock, stale_after):
+    """Check whether the worker that created a lock is gone"""
+    try:
+        with open(lock) as f:
+            host, pid = f.read().split()
+        age = time.time() - os.path.getmtime(lock)
+    except (OSError, ValueError):
+        # Removed by its owner in the meantime, or still being written
+        return False
+
+    if age > stale_after:
+        return True
+
+    if host != socket.gethostname():
+        return False
+
+    try:
+        os.kill(int(pid), 0)
+    except OSError:
+        return True
+
+    return False
+
+
+def run_shard(job_dir, shard, stale_after=24 * 3600):
+    """ Process a single shard and checkpoint its result
+
+    :param job_dir: The job directory
+    :param shard: Index of the shard
+    :param stale_after: Seconds after which another worker's lock is considered abandoned
+    :return: None if the shard is complete or owned by another worker, otherwise the error message
+    """
+    result_file = shard_path(job_dir, shard, 'npz')
+
+    if os.path.exists(result_file) or not claim(job_dir, shard, stale_after):
+        return None
+
+    try:
+        # Another worker may have finished the shard and released its lock between the check above and the claim
+        if os.path.exists(result_file):
+            return None
+
+        job = load_job(job_dir)
+        process = TASKS[job['task']][0]
+
+        file_names = job['shards'][shard]
+        images = load_files(file_names).images
+        result = process(images, file_names, **job['kwargs'])
+
+        # Write under a temporary name first so that a crash never leaves a partial checkpoint behind
+        temporary = shard_path(job_dir, shard, 'tmp')
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, **result)
+        os.replace(temporary, result_file)
+
+        try:
+            os.remove(shard_path(job_dir, shard, 'error'))
+        except FileNotFoundError:
+            pass
+
+        return None
+
+    except Exception as e:
+        message = "{0}: {1}".format(type(e).__name__, e)
+        with open(shard_path(job_dir, shard, 'error'), 'w') as f:
+            f.write(message)
+        return message
+
+    finally:
+        release(job_dir, shard)
+
+
+def _run_shard(args):
+    return args[1], run_shard(*args)
+
+
+def pending_shards(job_dir):
+    """The shards that don't have a result yet"""
+    return [shard for shard in range(len(load_job(job_dir)['shards']))
+            if not os.path.exists(shard_path(job_dir, shard, 'npz'))]
+
+
+def run_job(job_dir, processes=None, stale_after=24 * 3600):
+    """ Process every pending shard of a job with a pool of local worker processes. Run the same call on other
+    machines that share the job directory to spread the work across them
+
+    :param job_dir: The job directory
+    :param processes: Number of worker processes. Defaults to the number of CPUs
+    :param stale_after: Seconds after which another worker's lock is considered abandoned
+    :return: Dictionary of the shards that failed and their error messages
+    """
+    shards = pending_shards(job_dir)
+    failures = {}
+
+    pool = Pool(processes)
+    try:
+        for shard, error in pool.imap_unordered(_run_shard, [(job_dir, s, stale_after) for s in shards]):
+            if error is not None:
+                failures[shard] = error
+    finally:
+        pool.close()
+        pool.join()
+
+    return failures
+
+
+def merge_job(job_dir):
+    """ Merge the results of every shard in a job
+
+    :param job_dir: The job directory
+    :return: The merged result of the task
+    """
+    missing = pending_shards(job_dir)
+    if missing:
+        raise RuntimeError("{0} shards are not complete: {1}".format(len(missing), missing))
+
+    job = load_job(job_dir)
+    merge = TASKS[job['task']][1]
+
+    results = []
+    for shard in range(len(job['shards'])):
+        with np.load(shard_path(job_dir, shard, 'npz')) as data:
+            results.append({name: data[name] for name in data.files})
+
+    return merge(results)
+
+
+# Example usage
+if __name__ == "__main__":
+
+    directory_day100 = 'C:/Users/kalkiek/Desktop/repos/data/navcam1/DAY100/'
+    job_directory = 'C:/Users/kalkiek/Desktop/repos/jobs/navcam1_day100_hot_pixels/'
+
+    # Creating the job only happens once. Rerunning the script resumes from the completed shards
+    if not os.path.exists(os.path.join(job_directory, 'job.json')):
+        create_job([directory_day100], job_directory, 'hot_pixels', shard_size=20, sigma=4)
+
+    failed = run_job(job_directory)
+
+    for shard, error in sorted(failed.items()):
+        print("Shard {0} failed: {1}".format(shard, error))
+
+    if not failed:
+        overlap = merge_job(job_directory)
+        print("Located {0} overlapping active pixels".format(len(overlap)))
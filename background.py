@@ -0,0 +1,213 @@
+from load_tagcam import load_tagcam
+from stray_light import parse_time
+import numpy as np
+from numpy.polynomial import legendre
+from matplotlib import pyplot as plt
+
+__doc__ = """
+Model the smooth background (stray light) across the full image instead of sampling four corner boxes.
+
+Each image is binned into a coarse grid of block medians. Stars and hot pixels are rejected within every block by
+sigma clipping, so the grid only follows the background. A low order 2D Legendre polynomial is then fit to the grid.
+The polynomial coefficients are a compact description of the stray light (the time series to compare with the sun
+angle) and the full resolution model is only evaluated when it's needed, ex. to subtract it before thresholding in
+find_hps or find_streaks.
+
+Everything works on a single image (height, width) or a stack of images (count, height, width) at once.
+"""
+
+
+# Scale factor to turn the median absolute deviation into a standard deviation estimate for gaussian noise
+MAD_TO_STD = 1.4826
+
+
+def masked_median(values, valid):
+    """ Median along the last axis using only the valid values. Vectorized replacement for a loop of medians
+
+    :param values: Array of values
+    :param valid: Boolean mask of the values to use, same shape as values
+    :return: The median of the valid values along the last axis. NaN where there are no valid values
+    """
+    ordered = np.sort(np.where(valid, values, np.inf), axis=-1)
+    count = valid.sum(axis=-1)
+
+    low = np.take_along_axis(ordered, np.maximum((count - 1) // 2, 0)[..., np.newaxis], axis=-1)[..., 0]
+    high = np.take_along_axis(ordered, np.maximum(count // 2, 0)[..., np.newaxis], axis=-1)[..., 0]
+
+    return np.where(count > 0, (low + high) / 2, np.nan)
+
+
+def block_statistics(frames, block=64, sigma=3, iterations=2):
+    """ Sigma clipped median and noise of each block in the images. Stars and hot pixels are clipped out
+
+    :param frames: A single image or a stack of images
+    :param block: Height and width of the blocks in pixels
+    :param sigma: Values further than this many deviations from the block median are rejected
+    :param iterations: Number of clipping passes
+    :return: Grids of the block medians and block noise, shape (rows, cols) or (count, rows, cols)
+    """
+    frames = np.asarray(frames, dtype=float)
+    height, width = frames.shape[-2:]
+    rows, cols = -(-height // block), -(-width // block)
+
+    # Pad the partial blocks along the bottom and right edges with the edge values
+    padding = [(0, 0)] * (frames.ndim - 2) + [(0, rows * block - height), (0, cols * block - width)]
+    padded = np.pad(frames, padding, mode='edge')
+
+    shape = frames.shape[:-2] + (rows, block, cols, block)
+    blocks = np.swapaxes(padded.reshape(shape), -3, -2).reshape(frames.shape[:-2] + (rows, cols, block * block))
+
+    valid = np.ones(blocks.shape, dtype=bool)
+    median = np.median(blocks, axis=-1)
+    noise = np.median(np.abs(blocks - median[..., np.newaxis]), axis=-1) * MAD_TO_STD
+
+    for i in range(iterations):
+        valid = np.abs(blocks - median[..., np.newaxis]) <= sigma * np.maximum(noise, 1e-12)[..., np.newaxis]
+        median = masked_median(blocks, valid)
+        noise = masked_median(np.abs(blocks - median[..., np.newaxis]), valid) * MAD_TO_STD
+
+    return median, noise
+
+
+def block_centers(shape, block=64):
+    """ Pixel coordinates of the center of each block, accounting for the partial blocks along the edges
+
+    :param shape: The image shape (height, width)
+    :param block: Height and width of the blocks in pixels
+    :return: The row centers and column centers
+    """
+    height, width = shape
+    starts_y, starts_x = np.arange(0, height, block), np.arange(0, width, block)
+
+    return ((starts_y + np.minimum(starts_y + block, height) - 1) / 2,
+            (starts_x + np.minimum(starts_x + block, width) - 1) / 2)
+
+
+def normalize(coordinates, size):
+    """Map pixel coordinates 0..size-1 onto -1..1, the domain of the Legendre polynomials"""
+    return 2 * np.asarray(coordinates, dtype=float) / (size - 1) - 1
+
+
+def fit_surface(grid, shape, block=64, degree=3, sigma=3):
+    """ Least squares fit of a 2D Legendre polynomial to block median grids. Blocks that still disagree with the
+    first fit (ex. covered by a bright extended object) are rejected and the fit is repeated
+
+    :param grid: Block medians, shape (rows, cols) or (count, rows, cols)
+    :param shape: The image shape (height, width)
+    :param block: Height and width of the blocks in pixels
+    :param degree: Polynomial degree along each axis
+    :param sigma: Blocks with residuals further than this many deviations are rejected
+    :return: The coefficients, shape (degree + 1, degree + 1) or (count, degree + 1, degree + 1)
+    """
+    grid = np.asarray(grid, dtype=float)
+    single = grid.ndim == 2
+    grid = grid.reshape((-1,) + grid.shape[-2:])
+
+    rows, cols = block_centers(shape, block)
+    y, x = np.meshgrid(normalize(rows, shape[0]), normalize(cols, shape[1]), indexing='ij')
+
+    # One design matrix shared by every image. Coefficient [i, j] multiplies P_i(y) * P_j(x)
+    design = legendre.legvander2d(y.ravel(), x.ravel(), [degree, degree])
+    values = grid.reshape(len(grid), -1)
+
+    weights = np.isfinite(values).astype(float)
+    values = np.where(weights > 0, values, 0)
+
+    for i in range(2):
+        # Every image needs at least as many valid blocks as coefficients, also after the outlying blocks are rejected
+        count = (weights > 0).sum(axis=1).min()
+        if count < (degree + 1) ** 2:
+            raise ValueError("Only {0} valid blocks to fit {1} coefficients. Use a smaller block or degree".format(
+                count, (degree + 1) ** 2))
+
+        # Weighted normal equations for every image at once
+        normal = np.einsum('nk,ki,kj->nij', weights, design, design)
+        right = np.einsum('nk,ki,nk->ni', weights, design, values)
+        coefficients = np.linalg.solve(normal, right[..., np.newaxis])[..., 0]
+
+        residuals = values - coefficients @ design.T
+        spread = masked_median(np.abs(residuals), weights > 0) * MAD_TO_STD
+        weights = weights * (np.abs(residuals) <= sigma * np.maximum(spread, 1e-12)[:, np.newaxis])
+
+    coefficients = coefficients.reshape(len(grid), degree + 1, degree + 1)
+    return coefficients[0] if single else coefficients
+
+
+def fit_background(frames, block=64, degree=3, sigma=3, chunk_size=2):
+    """ Fit a smooth background surface to each image. The block statistics need about 250 MB of working memory per
+    full NavCam image, so a stack is binned a few images at a time and only the small block grids are kept
+
+    :param frames: A single image or a stack (array or list) of images
+    :param block: Height and width of the blocks in pixels
+    :param degree: Polynomial degree along each axis
+    :param sigma: Clipping threshold for rejecting stars, hot pixels and outlying blocks
+    :param chunk_size: Number of images binned at once
+    :return: The coefficients, shape (degree + 1, degree + 1) or (count, degree + 1, degree + 1)
+    """
+    if np.ndim(frames[0]) == 1:
+        return fit_background([frames], block=block, degree=degree, sigma=sigma, chunk_size=chunk_size)[0]
+
+    grid = np.concatenate([block_statistics(frames[start:start + chunk_size], block=block, sigma=sigma)[0]
+                           for start in range(0, len(frames), chunk_size)])
+
+    return fit_surface(grid, np.shape(frames[0]), block=block, degree=degree, sigma=sigma)
+
+
+def background_model(coefficients, shape, step=1):
+    """ Evaluate the background surface on the pixel grid
+
+    :param coefficients: Coefficients from fit_background
+    :param shape: The image shape (height, width)
+    :param step: Evaluate every step-th pixel for a cheaper, lower resolution model
+    :return: The model, shape (height, width) or (count, height, width) when step is 1
+    """
+    height, width = shape
+    rows = legendre.legvander(normalize(np.arange(0, height, step), height), coefficients.shape[-2] - 1)
+    cols = legendre.legvander(normalize(np.arange(0, width, step), width), coefficients.shape[-1] - 1)
+
+    return np.einsum('yi,...ij,xj->...yx', rows, coefficients, cols)
+
+
+def subtract_background(frames, block=64, degree=3, sigma=3, chunk_size=2):
+    """ Remove the smooth background from each image. The images are subtracted one at a time so a stack is never
+    copied as a whole
+
+    :param frames: A single image or a stack (array or list) of images
+    :param block: Height and width of the blocks in pixels
+    :param degree: Polynomial degree along each axis
+    :param sigma: Clipping threshold for rejecting stars, hot pixels and outlying blocks
+    :param chunk_size: Number of images binned at once
+    :return: The background subtracted image, or a list of them for a stack
+    """
+    if np.ndim(frames[0]) == 1:
+        return subtract_background([frames], block=block, degree=degree, sigma=sigma, chunk_size=chunk_size)[0]
+
+    coefficients = fit_background(frames, block=block, degree=degree, sigma=sigma, chunk_size=chunk_size)
+
+    return [np.asarray(im, dtype=float) - background_model(c, np.shape(im)) for im, c in zip(frames, coefficients)]
+
+
+# Example usage
+if __name__ == "__main__":
+
+    directory = 'C:/Users/kalkiek/Desktop/repos/data/navcam2/DAY100/'
+
+    navcam2 = load_tagcam(directories=[directory])
+
+    # Correct orientation. Raw read function returns the image flipped. Kept as a list of views so the images aren't
+    # copied into one large stack
+    frames = [np.fliplr(im) for im in navcam2.images]
+    times = [parse_time(im.obsdate) for im in navcam2.images]
+
+    coefficients = fit_background(frames)
+
+    # The constant term is the mean stray light level. The first order terms are the top-bottom and left-right slopes
+    plt.plot(times, coefficients[:, 0, 0], 'ro', label='Mean level')
+    plt.plot(times, coefficients[:, 1, 0], 'go', label='Top-bottom gradient')
+    plt.plot(times, coefficients[:, 0, 1], 'bo', label='Left-right gradient')
+
+    plt.legend()
+    plt.title("Background Surface Coefficients")
+    plt.ylabel('DN')
+    plt.xlabel('April 10th Time')
+    plt.show()
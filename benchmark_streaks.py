@@ -0,0 +1,90 @@
+import numpy as np
+from time import time
+from synthetic import Synthetic
+from find_streaks import find_streaks, StreakFilterBank
+from skimage.draw import line_aa
+
+__doc__ = """
+Compare the canny + hough and matched filter streak detection engines on synthetic images with injected streaks.
+Streaks are injected at a range of brightnesses so the detection rate of dim streaks can be compared along with the
+false detection count and the run time per image. The combined background noise of the synthetic images is about 2.1
+DN, so the long streaks at 2 DN and below are at or under the per-pixel noise.
+"""
+
+
+def inject_streaks(image, count, value, length_range=(15, 40), border=60):
+    """ Add randomly placed and oriented anti-aliased streaks to an image
+
+    :param image: The image to add the streaks to
+    :param count: Number of streaks
+    :param value: Peak DN of the streaks above the background
+    :param length_range: Range of streak lengths in pixels
+    :param border: Keep the streaks this many pixels away from the image edges
+    :return: The image with the streaks added
+    """
+    y, x = image.shape
+
+    for c in range(count):
+        length = np.random.randint(*length_range)
+        angle = np.random.uniform(0, np.pi)
+        dy, dx = int(round(length * np.sin(angle))), int(round(length * np.cos(angle)))
+
+        # Pick the start so that both ends of the streak stay inside the border
+        y_start = np.random.randint(border, y - border - dy)
+        x_start = np.random.randint(border - min(dx, 0), x - border - max(dx, 0))
+        y_end, x_end = y_start + dy, x_start + dx
+
+        rr, cc, val = line_aa(y_start, x_start, y_end, x_end)
+        image[rr, cc] += val * value
+
+    return image
+
+
+def benchmark(synthetic, values, count=5, frames=3, methods=('hough', 'matched'), length_range=(15, 40), bank=None):
+    """ Run the streak detection engines over synthetic images with injected streaks
+
+    :param synthetic: Instance of Synthetic used to generate the images
+    :param values: Streak brightnesses to test
+    :param count: Number of streaks injected into each image
+    :param frames: Number of images per brightness
+    :param methods: The find_streaks methods to compare
+    :param length_range: Range of streak lengths in pixels
+    :param bank: The StreakFilterBank used by the matched method. Defaults to StreakFilterBank()
+    :return: Dictionary keyed by (method, value) holding the average streak count and seconds per image
+    """
+    if bank is None:
+        bank = StreakFilterBank()
+    results = {}
+
+    for value in values:
+        images = [inject_streaks(synthetic.generate_image(exposure=5), count, value, length_range=length_range)
+                  for f in range(frames)]
+
+        for method in methods:
+            start = time()
+            streak_counts = [find_streaks(im, method=method, bank=bank) for im in images]
+            results[(method, value)] = (np.mean(streak_counts), (time() - start) / frames)
+
+    return results
+
+
+# Example usage
+if __name__ == "__main__":
+
+    psf = np.ones((3, 3)) / 3**2
+    synthetic = Synthetic(shape=(1000, 1000), background_mean=100, background_std=1.5, psf=psf, star_count=25)
+
+    results = benchmark(synthetic, values=[20, 6, 4])
+
+    for (method, value), (streak_count, seconds) in sorted(results.items()):
+        print("{0:8s} value {1:4.1f}: {2:7.1f} streaks (5 injected) {3:6.2f} s per image".format(method, value,
+                                                                                                streak_count, seconds))
+
+    # Streaks at or below the per-pixel noise are only found by integrating along a long streak with a long kernel
+    results = benchmark(synthetic, values=[3, 2, 1.5], methods=('matched',), length_range=(80, 150),
+                        bank=StreakFilterBank(lengths=(9, 17, 33, 65, 129)))
+
+    for (method, value), (streak_count, seconds) in sorted(results.items()):
+        print("{0:8s} value {1:4.1f}: {2:7.1f} long streaks (5 injected) {3:6.2f} s per image".format(method, value,
+                                                                                                     streak_count,
+                                                                                                     seconds))
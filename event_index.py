@@ -0,0 +1,309 @@
+from load_tagcam import load_tagcam
+from stray_light import parse_time
+from background import block_statistics
+import numpy as np
+from scipy import ndimage
+
+__doc__ = """
+Hot pixels, streaks and particle hits are all groups of pixels above the local background. Instead of rescanning every
+image for each new question, extract every above-background pixel cluster from every image once and store them in a
+columnar event table (one numpy array per column). The table is indexed by time and by position on a coarse pixel grid
+so that questions like "which pixels are active in every frame" or "events near (x, y) in April" are answered from the
+index without reading the images again.
+"""
+
+
+# Columns of the event table. x, y are the flux weighted centroid and mu20, mu02, mu11 the central second moments
+COLUMNS = ('frame', 'time', 'x', 'y', 'x_min', 'y_min', 'x_max', 'y_max',
+           'area', 'flux', 'peak', 'mu20', 'mu02', 'mu11', 'elongation')
+
+
+def local_background(im, block=64):
+    """ Estimate the background and noise level of an image from the clipped median of coarse blocks
+
+    :param im: The image
+    :param block: Height and width of the blocks in pixels
+    :return: Full size background and noise images
+    """
+    height, width = im.shape
+    median, noise = block_statistics(im, block=block)
+
+    def expand(grid):
+        return np.repeat(np.repeat(grid, block, axis=0), block, axis=1)[:height, :width]
+
+    return expand(median), expand(noise)
+
+
+def empty_table():
+    """An event table with no events"""
+    table = {name: np.zeros(0) for name in COLUMNS}
+    table['frame'] = np.zeros(0, dtype=int)
+    return table
+
+
+def frame_events(im, sigma=5, block=64):
+    """ Find every cluster of pixels above the local background in an image and measure it
+
+    :param im: The image
+    :param sigma: Number of local noise deviations above the local background a pixel must be to be active
+    :param block: Block size used to estimate the local background
+    :return: Event table (dictionary of columns) without the frame and time columns filled in
+    """
+    background, noise = local_background(im, block=block)
+    signal = np.asarray(im, dtype=float) - background
+
+    labels, count = ndimage.label(signal > sigma * noise, structure=np.ones((3, 3)))
+
+    table = empty_table()
+    if count == 0:
+        return table
+
+    # Accumulate every statistic with bincount over the active pixels instead of looping over the clusters
+    y, x = np.nonzero(labels)
+    ids = labels[y, x] - 1
+    weights = signal[y, x]
+
+    flux = np.bincount(ids, weights, minlength=count)
+    x_center = np.bincount(ids, weights * x, minlength=count) / flux
+    y_center = np.bincount(ids, weights * y, minlength=count) / flux
+
+    dx, dy = x - x_center[ids], y - y_center[ids]
+    mu20 = np.bincount(ids, weights * dx * dx, minlength=count) / flux
+    mu02 = np.bincount(ids, weights * dy * dy, minlength=count) / flux
+    mu11 = np.bincount(ids, weights * dx * dy, minlength=count) / flux
+
+    # Ratio of the major to minor axis. A single pixel still has a variance of 1/12 along each axis
+    spread = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+    major = (mu20 + mu02) / 2 + spread
+    minor = np.maximum((mu20 + mu02) / 2 - spread, 1 / 12)
+
+    slices = ndimage.find_objects(labels)
+
+    table.update({
+        'x': x_center, 'y': y_center,
+        'x_min': np.array([s[1].start for s in slices]), 'y_min': np.array([s[0].start for s in slices]),
+        'x_max': np.array([s[1].stop - 1 for s in slices]), 'y_max': np.array([s[0].stop - 1 for s in slices]),
+        'area': np.bincount(ids, minlength=count), 'flux': flux,
+        'peak': np.asarray(ndimage.maximum(signal, labels, np.arange(1, count + 1))),
+        'mu20': mu20, 'mu02': mu02, 'mu11': mu11, 'elongation': np.sqrt(np.maximum(major, 1 / 12) / minor),
+        'frame': np.zeros(count, dtype=int), 'time': np.zeros(count)
+    })
+
+    return table
+
+
+def concatenate(tables):
+    """Join event tables column by column"""
+    tables = list(tables)
+    if not tables:
+        return empty_table()
+
+    return {name: np.concatenate([table[name] for table in tables]) for name in COLUMNS}
+
+
+def extract_events(images, times=None, first_frame=0, sigma=5, block=64):
+    """ Extract the events from a set of images into an event table
+
+    :param images: The images to extract the events from
+    :param times: Time of each image (ex. from parse_time). Defaults to the frame number
+    :param first_frame: Frame number of the first image. Used to keep frame numbers unique across directories
+    :param sigma: Number of local noise deviations above the local background a pixel must be to be active
+    :param block: Block size used to estimate the local background
+    :return: The event table and the time of every frame
+    """
+    frames = np.arange(first_frame, first_frame + len(images))
+    frame_times = frames if times is None else as_times(times)
+
+    tables = []
+    for index, im in enumerate(images):
+        table = frame_events(im, sigma=sigma, block=block)
+        table['frame'] = np.full(len(table['x']), frames[index], dtype=int)
+        table['time'] = np.full(len(table['x']), frame_times[index])
+        tables.append(table)
+
+    return concatenate(tables), frame_times
+
+
+def as_times(times):
+    """Store datetime objects as numpy datetimes so they can be sorted and searched"""
+    times = np.asarray(times)
+    if times.dtype == object:
+        times = times.astype('datetime64[ms]')
+    return times
+
+
+class EventIndex:
+    """ Event table with a temporal index (events sorted by time) and a spatial index (events bucketed into square
+    cells of the image). Query methods return indices into the table columns, which can be combined with numpy
+    """
+
+    def __init__(self, table, frame_times, cell_size=64):
+        self.table = {name: np.asarray(table[name]) for name in COLUMNS}
+        self.table['time'] = as_times(self.table['time'])
+        self.frame_times = as_times(frame_times)
+        self.cell_size = cell_size
+
+        # Temporal index
+        self.time_order = np.argsort(self.table['time'], kind='stable')
+        self.sorted_times = self.table['time'][self.time_order]
+
+        # Spatial index. Events are sorted by cell and cell_starts marks where each cell begins
+        cell_rows, cell_cols = self.cells(self.table['x'], self.table['y'])
+        self.grid_shape = (cell_rows.max() + 1, cell_cols.max() + 1) if len(self) else (0, 0)
+
+        cells = cell_rows * self.grid_shape[1] + cell_cols
+        self.cell_order = np.argsort(cells, kind='stable')
+        cell_count = self.grid_shape[0] * self.grid_shape[1]
+        self.cell_starts = np.searchsorted(cells[self.cell_order], np.arange(cell_count + 1))
+
+    def __len__(self):
+        return len(self.table['x'])
+
+    def __getitem__(self, column):
+        return self.table[column]
+
+    @property
+    def frame_count(self):
+        return len(self.frame_times)
+
+    def cells(self, x, y):
+        """The grid cell (row, column) of the given pixel coordinates"""
+        return (np.asarray(y) // self.cell_size).astype(int), (np.asarray(x) // self.cell_size).astype(int)
+
+    def between(self, start=None, end=None):
+        """ Find the events in a time range
+
+        :param start: Earliest time (inclusive). None for no lower limit
+        :param end: Latest time (exclusive). None for no upper limit
+        :return: Indices of the events
+        """
+        low = 0 if start is None else np.searchsorted(self.sorted_times, as_times(start), side='left')
+        high = len(self) if end is None else np.searchsorted(self.sorted_times, as_times(end), side='left')
+        return np.sort(self.time_order[low:high])
+
+    def near(self, x, y, radius, start=None, end=None):
+        """ Find the events with a centroid within a distance of a pixel, optionally in a time range
+
+        :param x: Column of the pixel
+        :param y: Row of the pixel
+        :param radius: Distance in pixels
+        :param start: Earliest time (inclusive)
+        :param end: Latest time (exclusive)
+        :return: Indices of the events
+        """
+        if not len(self):
+            return np.zeros(0, dtype=int)
+
+        (row_min, row_max), (col_min, col_max) = self.cells([x - radius, x + radius], [y - radius, y + radius])
+        # Clamp both ends to the grid. A search area entirely outside of the grid can not contain any events
+        row_min, row_max = np.clip([row_min, row_max], 0, self.grid_shape[0] - 1)
+        col_min, col_max = np.clip([col_min, col_max], 0, self.grid_shape[1] - 1)
+
+        if row_min > row_max or col_min > col_max:
+            return np.zeros(0, dtype=int)
+
+        candidates = [self.cell_order[self.cell_starts[row * self.grid_shape[1] + col_min]:
+                                      self.cell_starts[row * self.grid_shape[1] + col_max + 1]]
+                      for row in range(row_min, row_max + 1)]
+        candidates = np.sort(np.concatenate(candidates))
+        keep = (self.table['x'][candidates] - x) ** 2 + (self.table['y'][candidates] - y) ** 2 <= radius ** 2
+
+        if start is not None:
+            keep &= self.table['time'][candidates] >= as_times(start)
+        if end is not None:
+            keep &= self.table['time'][candidates] < as_times(end)
+
+        return candidates[keep]
+
+    def persistent(self, fraction=1.0, events=None):
+        """ Find the pixels that are active in at least a fraction of the frames. With the default fraction these are
+        the hot pixel candidates from find_hot_pixels
+
+        Pixels are located by the centroid of their event. A hot pixel that touches a star (or any other source) in a
+        frame is part of that source's event in that frame, so its centroid moves and that frame doesn't count for it
+
+        :param fraction: Fraction of the frames a pixel has to be active in
+        :param events: Only consider these event indices. Defaults to every event
+        :return: List of (y, x) pixel coordinates
+        """
+        if events is None:
+            events = np.arange(len(self))
+
+        pixels = np.column_stack((np.rint(self.table['y'][events]), np.rint(self.table['x'][events]))).astype(int)
+        frames = self.table['frame'][events]
+
+        # Count each pixel once per frame
+        unique = np.unique(np.column_stack((pixels, frames)), axis=0)
+        locations, counts = np.unique(unique[:, :2], axis=0, return_counts=True)
+
+        return [tuple(l) for l in locations[counts >= fraction * self.frame_count]]
+
+    def rate(self, interval, events=None):
+        """ Count events per time interval (ex. elongated events per hour)
+
+        :param interval: Length of the interval. A numpy timedelta64 when the times are datetimes
+        :param events: Only count these event indices. Defaults to every event
+        :return: The start time of each interval and the number of events in it
+        """
+        if events is None:
+            events = np.arange(len(self))
+
+        first = self.frame_times.min()
+        bins = ((self.frame_times.max() - first) // interval).astype(int) + 1
+        counts = np.bincount(((self.table['time'][events] - first) // interval).astype(int), minlength=bins)
+
+        return first + np.arange(bins) * interval, counts
+
+    def save(self, file_name):
+        """Save the event table and frame times to a compressed numpy file"""
+        np.savez_compressed(file_name, frame_times=self.frame_times, **self.table)
+
+    @classmethod
+    def load(cls, file_name, cell_size=64):
+        """Load an event index saved with EventIndex.save"""
+        with np.load(file_name) as data:
+            return cls({name: data[name] for name in COLUMNS}, data['frame_times'], cell_size=cell_size)
+
+
+def index_directories(directories, sigma=5, block=64, cell_size=64):
+    """ Run the extraction pass over every directory. Images are loaded one directory at a time to limit memory
+
+    :param directories: The locations of the raw files
+    :param sigma: Number of local noise deviations above the local background a pixel must be to be active
+    :param block: Block size used to estimate the local background
+    :param cell_size: Size of the spatial index cells in pixels
+    :return: An EventIndex of every event in every image
+    """
+    tables, frame_times = [], []
+    frame_count = 0
+
+    for directory in directories:
+        camera = load_tagcam(directories=[directory])
+
+        # Correct orientation. Raw read function returns the image flipped
+        images = [np.fliplr(im) for im in camera.images]
+        times = [parse_time(im.obsdate) for im in camera.images]
+
+        table, times = extract_events(images, times, first_frame=frame_count, sigma=sigma, block=block)
+        tables.append(table)
+        frame_times.append(times)
+        frame_count += len(images)
+
+    return EventIndex(concatenate(tables), np.concatenate(frame_times), cell_size=cell_size)
+
+
+# Example usage
+if __name__ == "__main__":
+
+    directory = 'C:/Users/kalkiek/Desktop/repos/data/navcam2/DAY100/'
+
+    events = index_directories([directory])
+    events.save('navcam2_day100_events.npz')
+
+    print("Indexed {0} events in {1} frames".format(len(events), events.frame_count))
+    print("Pixels active in every frame: {0}".format(len(events.persistent())))
+
+    elongated = np.where(events['elongation'] >= 3)[0]
+    hour_start, counts = events.rate(np.timedelta64(1, 'h'), events=elongated)
+    for start, count in zip(hour_start, counts):
+        print("{0}: {1} elongated events".format(start, count))
@@ -14,17 +14,21 @@ exclude their projected locations as potential hot pixels. The issue is that mos
 do not point at the same location. One possible solution is to identify the location of every single image,
 but that can be very computationally expensive and does not seem to produce better results.
 
+star_mask.py now makes that lookup cheap by indexing the catalogue on the sky. Pass the star masks it produces to
+find_hps to reject the projected star locations directly.
+
 """
 
 
-def in_bounds(coords):
+def in_bounds(coords, shape):
     """Make sure the coordinate being evaluated are actually in the image. If an active pixel is found on the very edge
      of an image, it's neighbor will be out of bounds
 
     :param coords: The x, y coordinates to check
+    :param shape: The image shape
     :return: True if the coordinates lie within the active image. False otherwise
     """
-    return coords[0] < 1944 and coords[1] < 2592
+    return 0 <= coords[0] < shape[0] and 0 <= coords[1] < shape[1]
 
 
 def active_neighbor(im, coords, active_threshold):
@@ -42,7 +46,7 @@ def active_neighbor(im, coords, active_threshold):
                  (x, y + 1), (x + 1, y + 1), (x - 1, y + 1)]
 
     for n in neighbors:
-        if in_bounds(n) and im[n] >= active_threshold:
+        if in_bounds(n, im.shape) and im[n] >= active_threshold:
             return True
 
     return False
@@ -65,11 +69,13 @@ def active_coordinates(im, active_threshold):
     return set(active_coords)
 
 
-def find_hps(images, sigma):
+def find_hps(images, sigma, star_masks=None):
     """ Find the intersection of the active coordinates for every image in the set
 
     :param navcam: Instance of a TagCamsCamera that holds the corrected images
     :param sigma: Number of deviations above the mean used to define the active threshold
+    :param star_masks: Optional boolean masks (one per image) that are True on known stars. Must have the same
+        orientation as the images, use star_mask(..., flip=True) for raw load_tagcam images
     :return: The overlapping coordinates of potential hot pixels for every image in the set
     """
 
@@ -79,6 +85,10 @@ def find_hps(images, sigma):
         active_threshold = im.mean() + (sigma * im.std())
         active_coords[index] = active_coordinates(im, active_threshold)
 
+        # Drop any active pixels that land on a catalogue star
+        if star_masks is not None:
+            active_coords[index] = set(c for c in active_coords[index] if not star_masks[index][c])
+
     # Return the intersection for the sets of active coordinates
     return list(set.intersection(*active_coords.values()))
 
@@ -1,5 +1,8 @@
 from load_tagcam import load_tagcam
+from background import MAD_TO_STD
 import numpy as np
+from scipy import ndimage
+from scipy.fft import rfft2, irfft2, next_fast_len
 from skimage.feature import canny
 from skimage.transform import probabilistic_hough_line
 from matplotlib import pyplot as plt
@@ -9,6 +12,13 @@ Identify potential streaks/particles in a set of images. The NavCam2 day 100 ima
 of streaks in the images and there is now a push to figure out the cause.
 
 Pre-process the images with a canny edge detector and use a hough transformation to identify lines in the images.
+
+The canny edges have to be unsmoothed to keep the dim streaks, which makes the hough transformation slow and noisy on
+noisy images. The alternative matched filter engine (method='matched') correlates the image with a bank of oriented
+line kernels instead. The image is transformed once and shared across the whole bank, so the cost per image only
+depends on the image size and the bank. Integrating along the streak picks up streaks below the per-pixel noise as
+long as they are long enough: a streak with a per-pixel signal-to-noise ratio s needs roughly (7 / s)^2 pixels, and a
+kernel in the bank about as long. Add longer kernels to the bank (ex. 129) to look for long, faint streaks.
 """
 
 
@@ -52,15 +62,336 @@ def count_streaks(lines, dist=25):
     return len(unique_points)
 
 
-def find_streaks(image):
+def line_kernel(length, angle, size=None):
+    """ Create a zero mean, unit norm kernel of a one pixel wide line through the kernel center
+
+    :param length: Length of the line in pixels
+    :param angle: Angle of the line in radians, measured from the +x axis towards +y (down the image)
+    :param size: Height and width of the kernel. Must be odd. Defaults to the smallest that fits the line
+    :return: The line kernel
+    """
+    if size is None:
+        size = 2 * (length // 2) + 1
+    radius = size // 2
+
+    y, x = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    along = x * np.cos(angle) + y * np.sin(angle)
+    across = y * np.cos(angle) - x * np.sin(angle)
+
+    # Anti-aliased line: weight falls off linearly with the distance from the line
+    kernel = np.clip(1 - np.abs(across), 0, None) * (np.abs(along) <= length / 2)
+
+    # Zero mean so that the background level (and any linear gradient) doesn't respond
+    kernel -= kernel.mean()
+    return kernel / np.sqrt((kernel ** 2).sum())
+
+
+def noise_level(image):
+    """ Robust estimate of the background level and noise of an image that isn't thrown off by stars and streaks
+
+    :param image: The image
+    :return: The background level and the standard deviation of the noise
+    """
+    background = np.median(image)
+    noise = np.median(np.abs(image - background)) * MAD_TO_STD
+    if noise == 0:
+        noise = image.std() or 1
+
+    return background, noise
+
+
+class StreakFilterBank:
+    """ Bank of oriented line kernels used as matched filters for streaks. The response of each kernel is in units of
+    the background noise, so a threshold on it is a signal-to-noise threshold
+    """
+
+    def __init__(self, lengths=(9, 17, 33, 65), clip=3, batch_size=8):
+        self.radius = max(lengths) // 2
+        self.clip = clip
+        self.batch_size = batch_size
+
+        # Lines are symmetric so only half a turn of angles is needed. Longer kernels need finer angle steps to stay on
+        # the streak, so the angles are spaced to keep the ends of neighboring kernels about a pixel apart
+        self.orientations = []
+        for length in lengths:
+            angle_count = max(8, int(np.ceil(np.pi * length / 4)))
+            self.orientations.extend((length, angle) for angle in np.arange(angle_count) * np.pi / angle_count)
+
+        size = 2 * self.radius + 1
+        self.kernels = np.array([line_kernel(length, angle, size) for length, angle in self.orientations],
+                                dtype=np.float32)
+
+    def __len__(self):
+        return len(self.kernels)
+
+    def response(self, image, mask=None):
+        """ Correlate the image with every kernel in the bank and keep the best response at each pixel
+
+        :param image: The image to filter
+        :param mask: Optional boolean mask of pixels (ex. stars) that are replaced by the background before filtering
+        :return: The best signal-to-noise response at each pixel and the index of the kernel that produced it
+        """
+        image = np.asarray(image, dtype=float)
+        height, width = image.shape
+        radius = self.radius
+
+        # Clip the image in units of the noise so that a few very bright pixels can't carry a long kernel on their own
+        background, noise = noise_level(image)
+        normalized = np.clip((image - background) / noise, -self.clip, self.clip)
+        if mask is not None:
+            normalized[mask] = 0
+
+        # Pad to avoid wrap-around and to a size that FFTs quickly
+        shape = (next_fast_len(height + 2 * radius), next_fast_len(width + 2 * radius))
+
+        # A single forward transform of the image is shared by every kernel
+        # Single precision halves the cost and is plenty for a detection threshold
+        image_fft = rfft2(normalized.astype(np.float32), shape, workers=-1)
+
+        best = np.full(image.shape, -np.inf, dtype=np.float32)
+        best_index = np.zeros(image.shape, dtype=int)
+
+        for start in range(0, len(self.kernels), self.batch_size):
+            kernel_fft = rfft2(self.kernels[start:start + self.batch_size], shape, workers=-1)
+            responses = irfft2(kernel_fft * image_fft, shape, workers=-1)[:, radius:radius + height,
+                                                                           radius:radius + width]
+
+            batch_index = responses.argmax(axis=0)
+            batch_best = np.take_along_axis(responses, batch_index[np.newaxis], axis=0)[0]
+
+            better = batch_best > best
+            best[better] = batch_best[better]
+            best_index[better] = batch_index[better] + start
+
+        return best, best_index
+
+
+def point_sources(normalized, sigma=5, min_elongation=3, grow=2):
+    """ Mask the compact bright sources (stars, hot pixels and particle hits) in an image. Bright streaks are
+    elongated, so they are left alone
+
+    :param normalized: The background subtracted image in units of the noise
+    :param sigma: Number of noise deviations a pixel must be above the background to be part of a source
+    :param min_elongation: Sources at least this elongated are treated as streaks and not masked
+    :param grow: Number of pixels the sources are grown by. Covers the faint edges of the sources and joins the pieces
+        of a streak that dips below sigma here and there
+    :return: Boolean mask that is True on the compact sources
+    """
+    bright = normalized > sigma
+    if grow:
+        bright = ndimage.binary_dilation(bright, iterations=grow)
+
+    labels, count = ndimage.label(bright, structure=np.ones((3, 3)))
+    if count == 0:
+        return np.zeros(normalized.shape, dtype=bool)
+
+    # Second moments of every source at once. A single pixel still has a variance of 1/12 along each axis
+    y, x = np.nonzero(labels)
+    ids = labels[y, x] - 1
+    area = np.bincount(ids, minlength=count)
+
+    x_center, y_center = np.bincount(ids, x, minlength=count) / area, np.bincount(ids, y, minlength=count) / area
+    dx, dy = x - x_center[ids], y - y_center[ids]
+    mu20 = np.bincount(ids, dx * dx, minlength=count) / area
+    mu02 = np.bincount(ids, dy * dy, minlength=count) / area
+    mu11 = np.bincount(ids, dx * dy, minlength=count) / area
+
+    spread = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+    major = (mu20 + mu02) / 2 + spread
+    minor = np.maximum((mu20 + mu02) / 2 - spread, 1 / 12)
+    compact = np.sqrt(np.maximum(major, 1 / 12) / minor) < min_elongation
+
+    return np.concatenate(([False], compact))[labels]
+
+
+def best_segment(samples, min_length, clip=3):
+    """ Find the stretch of a line profile with the highest integrated signal-to-noise ratio. Samples are clipped so a
+    few very bright pixels (ex. stars) can't carry a segment on their own
+
+    :param samples: Profile along the line in units of the background noise
+    :param min_length: Shortest segment in samples
+    :param clip: Samples are limited to +/- this many deviations
+    :return: The start and stop index of the segment. None if the profile is shorter than min_length
+    """
+    if len(samples) < min_length:
+        return None
+
+    cumulative = np.concatenate(([0], np.cumsum(np.clip(samples, -clip, clip))))
+    start, stop = np.meshgrid(np.arange(len(samples) + 1), np.arange(len(samples) + 1), indexing='ij')
+    length = stop - start
+
+    score = np.where(length >= min_length, (cumulative[stop] - cumulative[start]) / np.sqrt(np.maximum(length, 1)),
+                     -np.inf)
+    start, stop = np.unravel_index(score.argmax(), score.shape)
+
+    return start, stop
+
+
+def weakest_part(samples, parts=3, clip=3):
+    """ Signal-to-noise ratio of the weakest part of a line profile. A streak is bright along its whole length, while
+    a star with some noise next to it or two stars joined by background leave at least one part empty
+
+    :param samples: Profile along the line in units of the background noise
+    :param parts: Number of equal parts the profile is split into
+    :param clip: Samples are limited to +/- this many deviations
+    :return: The smallest integrated signal-to-noise ratio of the parts
+    """
+    samples = np.clip(samples, -clip, clip)
+    return min(part.sum() / np.sqrt(len(part)) for part in np.array_split(samples, parts))
+
+
+def has_gap(samples):
+    """ Check a line profile for a drop to the background. A streak is evenly bright along its length, a pair of
+    touching stars dips between them. The allowed dip grows with the noise so dim streaks aren't rejected
+
+    :param samples: Profile along the line in units of the background noise
+    :return: True if the smoothed profile drops well below the level of the line
+    """
+    level = np.median(samples)
+
+    # Only look between the first and last sample that reach half the level, the segment can overhang the streak
+    bright = np.nonzero(samples >= level / 2)[0]
+    samples = samples[bright[0]:bright[-1] + 1]
+
+    if len(samples) < 3:
+        return False
+
+    # The noise of a 3 sample average is 1/sqrt(3). Allow a 3 deviation dip below a quarter of the line level
+    smoothed = np.convolve(samples, np.ones(3) / 3, mode='valid')
+    return smoothed.min() < level / 4 - 3 / np.sqrt(3)
+
+
+def matched_filter_lines(image, bank=None, threshold=6.5, min_part_snr=2, min_elongation=3, min_length=16,
+                         star_mask=None):
+    """ Identify streaks by thresholding the response of a streak filter bank
+
+    Stars respond to every kernel that passes through them, so their response is round. Streaks respond along their
+    length only, so candidates are kept only if the core (half of the peak response) of the region is elongated.
+    Two nearby stars also give an elongated core, so each candidate is checked on the image itself along the best
+    stretch of the line through the core. Each third of the line must pass min_part_snr on its own, which rejects
+    a star with noise next to it and stars joined by background, and it must not dip to the background, which rejects
+    touching stars.
+
+    The filter bank tests every position, angle and length (~10^8 tests for a 1000x1000 image), so the threshold
+    has to be high for noise alone to rarely pass it
+
+    :param image: The image to look for the streaks in
+    :param bank: The StreakFilterBank to use. Build one and reuse it when processing many images
+    :param threshold: Signal-to-noise cutoff of the filter bank response
+    :param min_part_snr: Smallest signal-to-noise ratio of each third of the line
+    :param min_elongation: Smallest ratio of the major to minor axis of the detection core for a streak
+    :param min_length: Shortest streak in pixels
+    :param star_mask: Optional boolean mask that is True on known stars. Must have the same orientation as
+        the image, use star_mask(..., flip=True) for raw load_tagcam images
+    :return: The lines identified in format ((x0, y0), (x1, y1))
+    """
+    if bank is None:
+        bank = StreakFilterBank()
+
+    background, noise = noise_level(image)
+    normalized = (np.asarray(image, dtype=float) - background) / noise
+    height, width = normalized.shape
+
+    # Stars respond to every kernel that passes near them, so they are removed before filtering
+    sources = point_sources(normalized, min_elongation=min_elongation)
+    if star_mask is not None:
+        sources |= star_mask
+
+    snr, _ = bank.response(image, mask=sources)
+
+    detected = (snr >= threshold) & ~sources
+
+    # The response of a streak can break up into pieces along its length. Grow the detections a little before
+    # labeling so that the pieces are joined into one region
+    labels, count = ndimage.label(ndimage.binary_dilation(detected, iterations=2), structure=np.ones((3, 3)))
+    slices = ndimage.find_objects(labels)
+
+    # A streak longer than the kernels can leave several regions along its length. Handle the strongest region first
+    # and skip the regions that lie on a streak that was already found
+    peaks = ndimage.maximum(np.where(detected, snr, 0), labels, np.arange(1, count + 1))
+    claimed = np.zeros(normalized.shape, dtype=bool)
+
+    lines = []
+    for label in np.argsort(peaks)[::-1] + 1:
+        region_slice = slices[label - 1]
+        region = (labels[region_slice] == label) & detected[region_slice]
+        region_snr = np.where(region, snr[region_slice], 0)
+        y, x = np.nonzero(region_snr >= region_snr.max() / 2)
+
+        if len(y) < 3:
+            continue
+
+        x = x + region_slice[1].start
+        y = y + region_slice[0].start
+
+        # Principal axes of the core. A single pixel wide line still has a variance of 1/12 across it
+        eigenvalues, eigenvectors = np.linalg.eigh(np.cov(np.vstack((x, y))))
+        elongation = np.sqrt(eigenvalues[1] / max(eigenvalues[0], 1 / 12))
+
+        if elongation < min_elongation:
+            continue
+
+        direction = eigenvectors[:, 1]
+        x_center, y_center = x.mean(), y.mean()
+
+        row, col = int(round(y_center)), int(round(x_center))
+        if claimed[max(row - 2, 0):row + 3, max(col - 2, 0):col + 3].any():
+            continue
+
+        distance = (x - x_center) * direction[0] + (y - y_center) * direction[1]
+
+        # Sample the image every pixel along the line. The core can be much shorter than a dim or long streak, so
+        # extend it by a kernel length at both ends and let best_segment find where the streak actually is
+        steps = np.arange(distance.min() - 2 * bank.radius, distance.max() + 2 * bank.radius + 1)
+        line_x = np.rint(x_center + steps * direction[0]).astype(int)
+        line_y = np.rint(y_center + steps * direction[1]).astype(int)
+
+        inside = (line_x >= 0) & (line_x < width) & (line_y >= 0) & (line_y < height)
+        steps, line_x, line_y = steps[inside], line_x[inside], line_y[inside]
+        samples = normalized[line_y, line_x]
+
+        segment = best_segment(samples, min_length)
+        if segment is None:
+            continue
+
+        start, stop = segment
+        if weakest_part(samples[start:stop]) < min_part_snr or has_gap(samples[start:stop]):
+            continue
+
+        claimed[line_y[start:stop], line_x[start:stop]] = True
+
+        ends = steps[start], steps[stop - 1]
+        lines.append(tuple((int(round(x_center + d * direction[0])), int(round(y_center + d * direction[1])))
+                           for d in ends))
+
+    return lines
+
+
+def find_streaks(image, star_mask=None, method='hough', bank=None):
     """ Identify potential streaks/particles in a set of images using canny edge detector and probabilistic hough lines
+    or the matched filter bank
 
     :param image: The image to look for the streaks in
+    :param star_mask: Optional boolean mask that is True on known stars. Must have the same orientation as
+        the image, use star_mask(..., flip=True) for raw load_tagcam images
+    :param method: 'hough' for canny edges and probabilistic hough lines, 'matched' for the streak filter bank
+    :param bank: The StreakFilterBank used by the matched method. Reuse one bank when processing many images
     :return: The number of streaks identified in the image
     """
+    if method == 'matched':
+        # Each detection is already a single connected streak, so there is nothing to merge
+        return len(matched_filter_lines(image, bank=bank, star_mask=star_mask))
+
+    if method != 'hough':
+        raise ValueError("Unknown streak detection method '{0}'".format(method))
+
     # No sigma because if you smooth the image you'll lose the dim streaks
     edges = canny(image, sigma=0)
 
+    # Star edges can't be part of a streak
+    if star_mask is not None:
+        edges &= ~star_mask
+
     lines = probabilistic_hough_line(edges, threshold=1, line_length=6,
                                      line_gap=1)
 
@@ -81,6 +412,7 @@ if __name__ == "__main__":
 
     navcam = load_tagcam([directory])
 
+    # Swap in method='matched', bank=StreakFilterBank() for the matched filter engine
     for index, im in enumerate(navcam.images):
         streak_count = find_streaks(im)
         print("Index {0}: Streak Count {1}".format(index, streak_count))
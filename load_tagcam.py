@@ -51,8 +51,17 @@ def load_tagcam(directories):
     for directory in directories:
         images.extend(load_directory(directory))
 
+    return load_files(images)
+
+
+def load_files(file_names):
+    """ Load in an instance of TagCamsCamera with the given raw files
+
+    :param file_names: The raw files to load
+    :return: A TagCamsCamera with the corrected images in the same order as the file names
+    """
     # Create an instance of the camera, adding the model and the images to be processed
-    navcam = TagCamsCamera(images=images, model=ncmodel, cam_name="navcam", spacecraft_name="orex")
+    navcam = TagCamsCamera(images=list(file_names), model=ncmodel, cam_name="navcam", spacecraft_name="orex")
 
     return navcam
 
@@ -75,6 +84,16 @@ def load_directory(directory):
     return images
 
 
+def file_id(file_name):
+    """ Use the last 4 digits before the file extension as the identifier. They're always unique
+
+    :param file_name: Name of the raw image file
+    :return: The 4 digit identifier
+    """
+    id_position = file_name.rfind('.') - 4
+    return file_name[id_position: id_position + 4]
+
+
 def raw_2_png(source_directory, destination):
     """ Convert raw NavCam images in a directory to PNG files
 
@@ -89,9 +108,6 @@ def raw_2_png(source_directory, destination):
         # Correct the orientation from the raw read function
         im = np.fliplr(im)
 
-        # Use the last 4 digits before the file extension as the identifier. They're always unique
-        id_position = file_names[index].rfind('.') - 4
-        f_id = file_names[index][id_position: id_position+4]
-        f_name = destination + f_id + ".png"
+        f_name = destination + file_id(file_names[index]) + ".png"
 
         io.imsave(f_name, im)
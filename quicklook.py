@@ -0,0 +1,189 @@
+from load_tagcam import load_files, load_directory, file_id
+import os
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+from skimage import io
+from skimage.transform import downscale_local_mean
+
+__doc__ = """
+Export quick-look image pyramids for browsing a whole downlink. Each image is block-mean downsampled by a factor of 2
+until it fits in a single tile, and every level is cut into small 8-bit PNG tiles:
+
+    destination/<file id>/<level>/<row>_<column>.png
+
+Level 0 is full resolution. A contact sheet mosaic of the smallest level of every image is also saved for each
+directory so the entire set can be reviewed at a glance.
+"""
+
+
+def display_limits(im, low=0.5, high=99.5):
+    """ Pick the DN range to display. Percentiles keep a few hot pixels or stars from washing out the image
+
+    :param im: The full resolution image
+    :param low: Percentile mapped to black
+    :param high: Percentile mapped to white
+    :return: The DN values mapped to 0 and 255
+    """
+    return tuple(np.percentile(im, (low, high)))
+
+
+def to_uint8(im, limits):
+    """ Scale an image to 0-255 using fixed display limits
+
+    :param im: The image
+    :param limits: The DN values mapped to 0 and 255
+    :return: The 8-bit image
+    """
+    low, high = limits
+    scaled = (im - low) * (255 / max(high - low, 1e-12))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def build_pyramid(im, tile=256, factor=2):
+    """ Repeatedly block-mean downsample an image until it fits in a single tile
+
+    :param im: The full resolution image
+    :param tile: Height and width of a tile in pixels
+    :param factor: Downsampling factor between levels
+    :return: List of the levels, starting with the full resolution image
+    """
+    levels = [np.asarray(im, dtype=float)]
+
+    while max(levels[-1].shape) > tile:
+        level = levels[-1]
+
+        # Crop to a multiple of the factor so downscale_local_mean doesn't pad the edges with zeros
+        height, width = level.shape
+        level = level[:height - height % factor, :width - width % factor]
+
+        levels.append(downscale_local_mean(level, (factor, factor)))
+
+    return levels
+
+
+def save_tiles(level, directory, tile, limits):
+    """ Cut a pyramid level into tiles and save them as 8-bit PNG files
+
+    :param level: The pyramid level
+    :param directory: Where the tiles of the level are saved
+    :param tile: Height and width of a tile in pixels
+    :param limits: The DN values mapped to 0 and 255
+    :return: Number of tiles saved
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    level = to_uint8(level, limits)
+    height, width = level.shape
+    count = 0
+
+    for row, y in enumerate(range(0, height, tile)):
+        for col, x in enumerate(range(0, width, tile)):
+            io.imsave(os.path.join(directory, "{0}_{1}.png".format(row, col)), level[y:y + tile, x:x + tile],
+                      check_contrast=False)
+            count += 1
+
+    return count
+
+
+def export_pyramid(im, destination, tile=256):
+    """ Build and save the tiled pyramid of an image
+
+    :param im: The full resolution image (already in the correct orientation)
+    :param destination: Directory for the levels of this image
+    :param tile: Height and width of a tile in pixels
+    :return: The smallest level as an 8-bit thumbnail
+    """
+    limits = display_limits(im)
+    levels = build_pyramid(im, tile=tile)
+
+    for index, level in enumerate(levels):
+        save_tiles(level, os.path.join(destination, str(index)), tile, limits)
+
+    return to_uint8(levels[-1], limits)
+
+
+def export_file(file_name, destination, tile=256):
+    """ Load a raw image file and export its pyramid
+
+    :param file_name: The raw image file
+    :param destination: Where the pyramids are saved. The pyramid goes in a directory named after the file id
+    :param tile: Height and width of a tile in pixels
+    :return: The smallest level as an 8-bit thumbnail
+    """
+    # Correct orientation. Raw read function returns the image flipped
+    im = np.fliplr(load_files([file_name]).images[0])
+
+    return export_pyramid(im, os.path.join(destination, file_id(file_name)), tile=tile)
+
+
+def export_pyramids(file_names, destination, tile=256, processes=None):
+    """ Export the pyramids of a set of raw image files in parallel. Each worker loads its own images, so only the
+    file names and the thumbnails are sent between the processes
+
+    :param file_names: The raw image files
+    :param destination: Where the pyramids are saved
+    :param tile: Height and width of a tile in pixels
+    :param processes: Number of worker processes. Defaults to the number of CPUs
+    :return: List of the 8-bit thumbnails of each image
+    """
+    pool = Pool(processes)
+    try:
+        return pool.map(partial(export_file, destination=destination, tile=tile), file_names)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def contact_sheet(thumbnails, columns=8, spacing=4):
+    """ Arrange thumbnails in a grid
+
+    :param thumbnails: The 8-bit thumbnails
+    :param columns: Number of thumbnails per row
+    :param spacing: Number of black pixels between thumbnails
+    :return: The mosaic image
+    """
+    height = max(t.shape[0] for t in thumbnails) + spacing
+    width = max(t.shape[1] for t in thumbnails) + spacing
+
+    columns = min(columns, len(thumbnails))
+    rows = -(-len(thumbnails) // columns)
+
+    sheet = np.zeros((rows * height - spacing, columns * width - spacing), dtype=np.uint8)
+
+    for index, thumbnail in enumerate(thumbnails):
+        y, x = (index // columns) * height, (index % columns) * width
+        sheet[y:y + thumbnail.shape[0], x:x + thumbnail.shape[1]] = thumbnail
+
+    return sheet
+
+
+def raw_2_pyramid(source_directory, destination, tile=256, columns=8, processes=None):
+    """ Convert raw NavCam images in a directory to quick-look pyramids and a contact sheet
+
+    :param source_directory: The directory that holds the raw image files
+    :param destination: Where the pyramids and contact sheet are saved
+    :param tile: Height and width of a tile in pixels
+    :param columns: Number of thumbnails per row of the contact sheet
+    :param processes: Number of worker processes. Defaults to the number of CPUs
+    :return: The contact sheet
+    """
+    file_names = sorted(load_directory(source_directory))
+    if not file_names:
+        raise ValueError("No raw files found in {0}".format(source_directory))
+
+    thumbnails = export_pyramids(file_names, destination, tile=tile, processes=processes)
+
+    sheet = contact_sheet(thumbnails, columns=columns)
+    io.imsave(os.path.join(destination, "contact_sheet.png"), sheet, check_contrast=False)
+
+    return sheet
+
+
+# Example usage
+if __name__ == "__main__":
+
+    directory = 'C:/Users/kalkiek/Desktop/repos/data/navcam2/DAY100/'
+
+    raw_2_pyramid(directory, 'C:/Users/kalkiek/Desktop/repos/data/quicklook/navcam2/DAY100/')
@@ -0,0 +1,277 @@
+from load_tagcam import fov, focal_x, focal_y, princ_point_x, princ_point_y, k1, k2, k3, p1, p2
+import numpy as np
+
+__doc__ = """
+Mask the stars in an image by projecting a local star catalogue through the camera model and the image attitude.
+
+Projecting the whole catalogue for every image is what made this approach too slow in find_hot_pixels. Instead the
+catalogue is indexed once into declination bands sorted by right ascension. For each image only the stars within the
+camera's field of view are pulled from the index, projected all at once, and drawn into a boolean mask.
+
+Camera frame convention: +z is the boresight, +x points along increasing columns and +y along increasing rows.
+
+Orientation: the masks are drawn in the corrected orientation, i.e. the raw load_tagcam images after np.fliplr (as
+done in stray_light.py and raw_2_png). find_hps and find_streaks are run on the raw, still flipped images in their
+example usage. Pass flip=True to star_mask to get masks that line up with those raw images.
+"""
+
+
+# The NavCam image size (rows, columns)
+IMAGE_SHAPE = (1944, 2592)
+
+
+def radec_to_vectors(ra, dec):
+    """ Convert right ascension and declination to inertial unit vectors
+
+    :param ra: Right ascension in degrees
+    :param dec: Declination in degrees
+    :return: Nx3 array of unit vectors
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack((np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)))
+
+
+def quaternion_to_rotation(q):
+    """ Convert an attitude quaternion to the rotation matrix from the inertial frame to the camera frame
+
+    :param q: Quaternion in scalar first order (w, x, y, z)
+    :return: 3x3 rotation matrix
+    """
+    w, x, y, z = np.asarray(q, dtype=float) / np.linalg.norm(q)
+
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y + w * z), 2 * (x * z - w * y)],
+                     [2 * (x * y - w * z), 1 - 2 * (x * x + z * z), 2 * (y * z + w * x)],
+                     [2 * (x * z + w * y), 2 * (y * z - w * x), 1 - 2 * (x * x + y * y)]])
+
+
+def pointing_rotation(ra, dec, roll=0):
+    """ Build the rotation matrix from the inertial frame to the camera frame for a boresight pointing. With no roll
+    the top of the image points north
+
+    :param ra: Right ascension of the boresight in degrees
+    :param dec: Declination of the boresight in degrees
+    :param roll: Rotation about the boresight in degrees
+    :return: 3x3 rotation matrix
+    """
+    boresight = radec_to_vectors(ra, dec)[0]
+
+    # Pick a different reference direction when looking straight at a pole
+    reference = np.array([0., 0., 1.]) if abs(boresight[2]) < 0.999999 else np.array([1., 0., 0.])
+
+    east = np.cross(reference, boresight)
+    east /= np.linalg.norm(east)
+    north = np.cross(boresight, east)
+
+    # Rows increase downwards, so +y is south
+    roll = np.radians(roll)
+    x = np.cos(roll) * east - np.sin(roll) * north
+    y = -np.sin(roll) * east - np.cos(roll) * north
+
+    return np.vstack((x, y, boresight))
+
+
+class StarIndex:
+    """ Star catalogue indexed into declination bands. Within each band the stars are sorted by right ascension so a
+    field of view query is a couple of binary searches per band
+    """
+
+    def __init__(self, ra, dec, magnitude=None, band_size=2.0):
+        ra = np.mod(np.asarray(ra, dtype=float), 360)
+        dec = np.asarray(dec, dtype=float)
+        magnitude = np.zeros(len(ra)) if magnitude is None else np.asarray(magnitude, dtype=float)
+
+        self.band_size = band_size
+        self.band_count = int(np.ceil(180 / band_size))
+
+        bands = self.band(dec)
+        order = np.lexsort((ra, bands))
+
+        self.ra, self.dec, self.magnitude = ra[order], dec[order], magnitude[order]
+        self.vectors = radec_to_vectors(self.ra, self.dec)
+
+        # Position in the sorted arrays where each band begins and ends
+        self.band_starts = np.searchsorted(bands[order], np.arange(self.band_count + 1))
+
+    def __len__(self):
+        return len(self.ra)
+
+    def band(self, dec):
+        """The declination band index for the given declinations"""
+        return np.clip(((np.asarray(dec) + 90) // self.band_size).astype(int), 0, self.band_count - 1)
+
+    def query(self, ra, dec, radius):
+        """ Find every star within a given angular distance of a point on the sky
+
+        :param ra: Right ascension of the center in degrees
+        :param dec: Declination of the center in degrees
+        :param radius: Search radius in degrees
+        :return: Indices into the index's (sorted) catalogue arrays
+        """
+        ra = np.mod(ra, 360)
+        first_band, last_band = self.band([dec - radius, dec + radius])
+
+        # Widest right ascension offset of any point on the circle. Near a pole the whole band is needed
+        if abs(dec) + radius < 90:
+            ra_offset = np.degrees(np.arcsin(np.sin(np.radians(radius)) / np.cos(np.radians(dec))))
+        else:
+            ra_offset = 180
+
+        if ra_offset >= 180:
+            ra_ranges = [(0, 360)]
+        elif ra - ra_offset < 0:
+            ra_ranges = [(0, ra + ra_offset), (ra - ra_offset + 360, 360)]
+        elif ra + ra_offset > 360:
+            ra_ranges = [(ra - ra_offset, 360), (0, ra + ra_offset - 360)]
+        else:
+            ra_ranges = [(ra - ra_offset, ra + ra_offset)]
+
+        candidates = []
+        for band in range(first_band, last_band + 1):
+            start, stop = self.band_starts[band], self.band_starts[band + 1]
+            band_ra = self.ra[start:stop]
+
+            for ra_min, ra_max in ra_ranges:
+                low = start + np.searchsorted(band_ra, ra_min, side='left')
+                high = start + np.searchsorted(band_ra, ra_max, side='right')
+                candidates.append(np.arange(low, high))
+
+        if not candidates:
+            return np.array([], dtype=int)
+
+        candidates = np.unique(np.concatenate(candidates))
+
+        # The bands and ranges form a box around the circle. Trim the corners
+        center = radec_to_vectors(ra, dec)[0]
+        inside = self.vectors[candidates] @ center >= np.cos(np.radians(radius))
+
+        return candidates[inside]
+
+
+def load_catalogue(file_name, band_size=2.0):
+    """ Load a local star catalogue from a comma separated file and index it
+
+    :param file_name: File with one star per line in the format ra, dec, magnitude (degrees)
+    :param band_size: Height of the declination bands in degrees
+    :return: A StarIndex of the catalogue
+    """
+    ra, dec, magnitude = np.loadtxt(file_name, delimiter=',', usecols=(0, 1, 2), unpack=True, ndmin=2)
+    return StarIndex(ra, dec, magnitude, band_size=band_size)
+
+
+def project_vectors(vectors, rotation, distort=False):
+    """ Project inertial unit vectors into the image using the NavCam camera model intrinsics
+
+    :param vectors: Nx3 array of inertial unit vectors
+    :param rotation: 3x3 rotation matrix from the inertial frame to the camera frame
+    :param distort: Apply the Brown distortion model. Images from load_tagcam are already corrected, so off by default
+    :return: The row and column of each vector in the image, and a mask of the vectors in front of the camera
+    """
+    camera = vectors @ np.asarray(rotation).T
+
+    in_front = camera[:, 2] > 0
+    z = np.where(in_front, camera[:, 2], 1)
+
+    x, y = camera[:, 0] / z, camera[:, 1] / z
+
+    if distort:
+        r2 = x ** 2 + y ** 2
+        radial = 1 + k1 * r2 + k2 * r2 ** 2 + k3 * r2 ** 3
+        x, y = (x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x ** 2),
+                y * radial + p1 * (r2 + 2 * y ** 2) + 2 * p2 * x * y)
+
+    return focal_y * y + princ_point_y, focal_x * x + princ_point_x, in_front
+
+
+def project_stars(index, rotation, shape=IMAGE_SHAPE, magnitude_limit=None, distort=False):
+    """ Find the pixel locations of the catalogue stars that fall within the image
+
+    :param index: StarIndex of the catalogue
+    :param rotation: 3x3 rotation matrix from the inertial frame to the camera frame
+    :param shape: The image shape (rows, columns)
+    :param magnitude_limit: Ignore stars dimmer than this magnitude
+    :param distort: Apply the Brown distortion model
+    :return: The rows, columns and magnitudes of the stars in the image
+    """
+    rotation = np.asarray(rotation)
+
+    # The boresight is the third row of the rotation matrix
+    boresight = rotation[2]
+    ra = np.degrees(np.arctan2(boresight[1], boresight[0]))
+    dec = np.degrees(np.arcsin(np.clip(boresight[2], -1, 1)))
+
+    stars = index.query(ra, dec, radius=fov / 2)
+
+    if magnitude_limit is not None:
+        stars = stars[index.magnitude[stars] <= magnitude_limit]
+
+    rows, cols, in_front = project_vectors(index.vectors[stars], rotation, distort=distort)
+
+    inside = in_front & (rows > -0.5) & (rows < shape[0] - 0.5) & (cols > -0.5) & (cols < shape[1] - 0.5)
+
+    return rows[inside], cols[inside], index.magnitude[stars][inside]
+
+
+def rasterize(rows, cols, shape=IMAGE_SHAPE, radius=3):
+    """ Draw a filled disk around each location
+
+    :param rows: Row of each location
+    :param cols: Column of each location
+    :param shape: The mask shape (rows, columns)
+    :param radius: Radius of the disks in pixels
+    :return: Boolean mask that is True inside the disks
+    """
+    mask = np.zeros(shape, dtype=bool)
+
+    if len(rows) == 0:
+        return mask
+
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = dy ** 2 + dx ** 2 <= radius ** 2
+    dy, dx = dy[disk], dx[disk]
+
+    all_rows = (np.rint(rows).astype(int)[:, np.newaxis] + dy).ravel()
+    all_cols = (np.rint(cols).astype(int)[:, np.newaxis] + dx).ravel()
+
+    inside = (all_rows >= 0) & (all_rows < shape[0]) & (all_cols >= 0) & (all_cols < shape[1])
+    mask[all_rows[inside], all_cols[inside]] = True
+
+    return mask
+
+
+def star_mask(index, rotation, shape=IMAGE_SHAPE, radius=3, magnitude_limit=None, distort=False, flip=False):
+    """ Mask every catalogue star in an image
+
+    :param index: StarIndex of the catalogue
+    :param rotation: 3x3 rotation matrix from the inertial frame to the camera frame (see quaternion_to_rotation)
+    :param shape: The image shape (rows, columns)
+    :param radius: Radius in pixels masked around each star
+    :param magnitude_limit: Ignore stars dimmer than this magnitude
+    :param distort: Apply the Brown distortion model
+    :param flip: Mirror the mask left to right to match the raw (uncorrected) load_tagcam images
+    :return: Boolean mask that is True on the stars
+    """
+    rows, cols, _ = project_stars(index, rotation, shape=shape, magnitude_limit=magnitude_limit, distort=distort)
+    mask = rasterize(rows, cols, shape=shape, radius=radius)
+
+    return np.fliplr(mask) if flip else mask
+
+
+# Example usage
+if __name__ == "__main__":
+
+    from time import time
+
+    # Random sky with roughly as many stars as a magnitude 9 catalogue
+    star_count = 120000
+    ra = np.random.uniform(0, 360, star_count)
+    dec = np.degrees(np.arcsin(np.random.uniform(-1, 1, star_count)))
+    magnitude = np.random.uniform(0, 9, star_count)
+
+    catalogue = StarIndex(ra, dec, magnitude)
+
+    start = time()
+    for pointing in range(100):
+        rotation = pointing_rotation(np.random.uniform(0, 360), np.random.uniform(-90, 90), np.random.uniform(0, 360))
+        mask = star_mask(catalogue, rotation, magnitude_limit=7)
+
+    print("{0:.2f} ms per image".format((time() - start) * 10))
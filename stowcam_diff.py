@@ -1,13 +1,27 @@
 from load_tagcam import load_tagcam
+from background import MAD_TO_STD
 import numpy as np
 from matplotlib import pyplot as plt
+from functools import partial
+from multiprocessing import Pool
+from scipy import ndimage
+from scipy.ndimage import fourier_shift
+from skimage.registration import phase_cross_correlation
 
 __doc__ = """
 On 3/16/17 new images of the StowCam arrived. The src has a black spot, and it is unsure
 of whether it is a particulate or burn off is occurring. To get a better understanding this program
 takes the difference between the new images and the launch 14 day images.
+
+The change detection engine (detect_change/detect_changes) does not assume the two frames are pixel-aligned. Each
+pair is sub-pixel registered first, the difference is normalized tile by tile against the local noise level, and
+significant changes are segmented into connected regions. The result is a short list of changed regions with
+statistics so every new StowCam downlink can be checked without looking at each difference image.
 """
 
+# Launch 14 day images were taken closer to the sun. Scale them down by this factor before comparing
+HELIOCENTRIC_FACTOR = 0.86133
+
 
 def stowcam_diff(im, im_l14):
     """ Find the difference between the launch 14 day image and the new image (3/16/17). Ignore saturated pixels
@@ -18,7 +32,7 @@ def stowcam_diff(im, im_l14):
     """
 
     # Multiply the launch 14 day images by a heliocentric factor to adjust for them being closer to the sun
-    im_l14 *= 0.86133
+    im_l14 *= HELIOCENTRIC_FACTOR
 
     # Estimated saturation threshold
     saturated = im.max() * 0.75
@@ -36,6 +50,191 @@ def stowcam_diff(im, im_l14):
     return difference
 
 
+def register_pair(im, im_l14, upsample_factor=20):
+    """ Sub-pixel register the launch 14 day image onto the new image using upsampled phase correlation
+
+    :param im: The new image
+    :param im_l14: The launch 14 day image with the same exposure time as the new image
+    :param upsample_factor: Registration precision. 20 -> 1/20th of a pixel
+    :return: The launch 14 day image shifted onto the new image, and the (y, x) shift that was applied
+    """
+    shift, _, _ = phase_cross_correlation(im, im_l14, upsample_factor=upsample_factor)
+
+    aligned = np.fft.ifftn(fourier_shift(np.fft.fftn(im_l14), shift)).real
+    return aligned, shift
+
+
+def saturation_mask(im, im_l14, fraction=0.75):
+    """ Mark the pixels that are saturated in either image
+
+    :param im: The new image
+    :param im_l14: The registered launch 14 day image
+    :param fraction: Fraction of the new image's max value that is considered saturated
+    :return: Boolean mask that is True where either image is saturated
+    """
+    saturated = im.max() * fraction
+    return (im >= saturated) | (im_l14 >= saturated)
+
+
+def tiled_significance(difference, valid, tile=256):
+    """ Normalize the difference image tile by tile. Each tile is centered on its median and divided by its robust
+    standard deviation so that uneven illumination across the SRC doesn't swamp the real changes
+
+    :param difference: The signed difference image
+    :param valid: Boolean mask of the pixels to use. Invalid pixels get a significance of 0
+    :param tile: The height and width of each tile in pixels
+    :return: The difference image in units of local standard deviations
+    """
+    significance = np.zeros(difference.shape)
+    height, width = difference.shape
+
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            block = difference[y:y + tile, x:x + tile]
+            block_valid = valid[y:y + tile, x:x + tile]
+            values = block[block_valid]
+
+            if values.size == 0:
+                continue
+
+            median = np.median(values)
+            noise = np.median(np.abs(values - median)) * MAD_TO_STD
+
+            # Flat tiles (ex. fully dark or clipped areas) fall back to the standard deviation
+            if noise == 0:
+                noise = values.std()
+            if noise == 0:
+                continue
+
+            significance[y:y + tile, x:x + tile] = np.where(block_valid, (block - median) / noise, 0)
+
+    return significance
+
+
+def changed_regions(difference, significance, threshold=5, min_area=4):
+    """ Segment the significant changes into connected regions and measure each one
+
+    :param difference: The signed difference image (new - launch 14 day)
+    :param significance: The difference image in units of local standard deviations
+    :param threshold: Number of deviations a pixel must differ by to be considered changed
+    :param min_area: Regions with fewer pixels than this are treated as noise and dropped
+    :return: A list of dictionaries describing each changed region, largest first
+    """
+    labels, _ = ndimage.label(np.abs(significance) >= threshold, structure=np.ones((3, 3)))
+
+    regions = []
+    for label, region_slice in enumerate(ndimage.find_objects(labels), start=1):
+        mask = labels[region_slice] == label
+        area = int(mask.sum())
+
+        if area < min_area:
+            continue
+
+        values = difference[region_slice][mask]
+        y_offset, x_offset = region_slice[0].start, region_slice[1].start
+        y_center, x_center = ndimage.center_of_mass(mask)
+
+        regions.append({
+            'bbox': (y_offset, x_offset, region_slice[0].stop, region_slice[1].stop),
+            'centroid': (y_center + y_offset, x_center + x_offset),
+            'area': area,
+            # Negative values mean the new image is darker (ex. the black spot on the SRC)
+            'mean_difference': float(values.mean()),
+            'total_difference': float(values.sum()),
+            'peak_significance': float(np.abs(significance[region_slice][mask]).max())
+        })
+
+    return sorted(regions, key=lambda r: r['area'], reverse=True)
+
+
+def detect_change(im, im_l14, tile=256, threshold=5, min_area=4, upsample_factor=20, keep_difference=False):
+    """ Register a new/launch 14 day image pair and find the regions that changed between them
+
+    :param im: The new image
+    :param im_l14: The launch 14 day image with the same exposure time as the new image
+    :param tile: The height and width of the tiles used to estimate the local noise level
+    :param threshold: Number of deviations a pixel must differ by to be considered changed
+    :param min_area: Smallest region in pixels that is reported
+    :param upsample_factor: Registration precision. 20 -> 1/20th of a pixel
+    :param keep_difference: Also return the full difference image. Off by default to keep results small
+    :return: A dictionary with the registration shift, the list of changed regions and optionally the difference
+    """
+    im = np.asarray(im, dtype=float)
+
+    # Copy so that the caller's launch 14 day image isn't scaled in place
+    im_l14 = np.asarray(im_l14, dtype=float) * HELIOCENTRIC_FACTOR
+
+    aligned, shift = register_pair(im, im_l14, upsample_factor=upsample_factor)
+    difference = im - aligned
+    valid = ~saturation_mask(im, aligned)
+
+    # The registration shift wraps pixels around the frame. Exclude the wrapped border
+    y_border, x_border = [int(np.ceil(abs(s))) for s in shift]
+    if y_border:
+        valid[:y_border], valid[-y_border:] = False, False
+    if x_border:
+        valid[:, :x_border], valid[:, -x_border:] = False, False
+
+    significance = tiled_significance(difference, valid, tile=tile)
+
+    result = {'shift': tuple(shift),
+              'regions': changed_regions(difference, significance, threshold=threshold, min_area=min_area)}
+
+    if keep_difference:
+        result['difference'] = difference
+
+    return result
+
+
+def _detect_change_pair(pair, **kwargs):
+    return detect_change(pair[0], pair[1], **kwargs)
+
+
+def match_exposures(exposures, exposures_l14, tolerance=1e-3):
+    """ Pair every new image with the launch 14 day image that has the same exposure time
+
+    :param exposures: Exposure time of each new image in seconds
+    :param exposures_l14: Exposure time of each launch 14 day image in seconds
+    :param tolerance: Largest difference in seconds for two exposure times to be considered the same
+    :return: Index of the matching launch 14 day image for every new image
+    """
+    exposures_l14 = np.asarray(exposures_l14, dtype=float)
+
+    matches = []
+    for index, exposure in enumerate(exposures):
+        offsets = np.abs(exposures_l14 - exposure)
+
+        if not len(offsets) or offsets.min() > tolerance:
+            raise ValueError("New image {0} ({1} s) has no launch 14 day image with the same exposure".format(
+                index, exposure))
+
+        matches.append(int(offsets.argmin()))
+
+    return matches
+
+
+def detect_changes(images, images_l14, exposures, exposures_l14, processes=None, **kwargs):
+    """ Run the change detection over every exposure matched image pair in parallel
+
+    :param images: The new images
+    :param images_l14: The launch 14 day images
+    :param exposures: Exposure time of each new image in seconds
+    :param exposures_l14: Exposure time of each launch 14 day image in seconds
+    :param processes: Number of worker processes. Defaults to the number of CPUs
+    :param kwargs: Passed on to detect_change
+    :return: A list of detect_change results, one per new image
+    """
+    matches = match_exposures(exposures, exposures_l14)
+    pairs = [(im, images_l14[match]) for im, match in zip(images, matches)]
+
+    pool = Pool(processes)
+    try:
+        return pool.map(partial(_detect_change_pair, **kwargs), pairs)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def get_panels(im):
     """We know that there is an increase of illumination on the src from the right to the left of the image
     If burn off is occurring, there will be a greater difference DN as we move along the src. To test for this
@@ -102,14 +301,22 @@ if __name__ == "__main__":
     stowcam = load_tagcam(directories=[directory])
     stowcam_l14 = load_tagcam(directories=[directory_l14])
 
-    if len(stowcam.images) != len(stowcam_l14.images):
-        print("Incorrect number of files provided")
-        exit(-1)
+    # Correct the image orientation
+    images = [np.fliplr(np.flipud(im)) for im in stowcam.images]
+    images_l14 = [np.fliplr(np.flipud(im)) for im in stowcam_l14.images]
+
+    # Exposure times (seconds) from the image headers
+    exposures = [im.exposure for im in stowcam.images]
+    exposures_l14 = [im.exposure for im in stowcam_l14.images]
+
+    for index, change in enumerate(detect_changes(images, images_l14, exposures, exposures_l14)):
+        print("Pair {0}: shift {1}, {2} changed regions".format(index, change['shift'], len(change['regions'])))
+        for region in change['regions'][:5]:
+            print(region)
 
-    for i in range(len(stowcam.images)):
-        # Correct the image orientation
-        im = np.fliplr(np.flipud(stowcam.images[i]))
-        im_l14 = np.fliplr(np.flipud(stowcam_l14.images[i]))
+    # Compare every new image with the launch 14 day image that has the same exposure
+    for i, j in enumerate(match_exposures(exposures, exposures_l14)):
+        im, im_l14 = images[i], images_l14[j]
 
         diff = stowcam_diff(im, im_l14.astype(float))
         print(diff.mean(), diff.std())
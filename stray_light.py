@@ -25,6 +25,22 @@ def get_grid(im, center, size):
               center[1] - offset:center[1] + offset + 1]
 
 
+def corner_means(im, size=31):
+    """ Average DN value in a square box in each corner of the image
+
+    :param im: The image (in the corrected orientation)
+    :param size: Height and width of the boxes. Arbitrary, but must be odd
+    :return: The mean of the top left, top right, bottom left and bottom right boxes
+    """
+    y, x = im.shape
+    offset = size // 2
+
+    return (get_grid(im, (offset, offset), size=size).mean(),
+            get_grid(im, (offset, x - offset - 1), size=size).mean(),
+            get_grid(im, (y - offset - 1, offset), size=size).mean(),
+            get_grid(im, (y - offset - 1, x - offset - 1), size=size).mean())
+
+
 def parse_time(obsdate):
     """ Take the date from the image header and format it into a datetime object
 
@@ -58,16 +74,11 @@ if __name__ == "__main__":
         # Correct orientation. Raw read function returns the image flipped
         im = np.fliplr(im)
 
-        y, x = im.shape
-
         # Grab a datetime representation of when the exposure begins
         time = parse_time(im.obsdate)
 
-        # Grab the average DN value of each corner. Arbitrary grid size
-        top_left = get_grid(im, (15, 15), size=31).mean()
-        top_right = get_grid(im, (15, x - 15), size=31).mean()
-        bottom_left = get_grid(im, (y - 15, 15), size=31).mean()
-        bottom_right = get_grid(im, (y - 15, x - 15), size=31).mean()
+        # Grab the average DN value of each corner
+        top_left, top_right, bottom_left, bottom_right = corner_means(im, size=31)
 
         plt.plot(time, top_left, 'ro')
         plt.plot(time, top_right, 'go')
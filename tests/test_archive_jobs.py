@@ -0,0 +1,123 @@
+import os
+import time
+import socket
+import unittest
+import tempfile
+import numpy as np
+from types import SimpleNamespace
+from unittest import mock
+from synthetic import Synthetic
+from find_hot_pixels import find_hps
+from archive_jobs import (hot_pixel_shard, merge_hot_pixels, concatenate_tables, create_job, run_job, merge_job,
+                          claim, release, run_shard, shard_path)
+from tests.test_find_hot_pixels import add_hot_pixels
+
+
+class TestArchiveJobs(unittest.TestCase):
+
+    # Create random images with the same hot pixels in each
+    def setUp(self):
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(600, 800), background_mean=100, background_std=1.5, psf=psf, star_count=25)
+
+        images = [synthetic.generate_image(exposure=e) for e in (2, 5, 10, 20)]
+        self.images = add_hot_pixels(images, count=10)
+
+    def tearDown(self):
+        self.images = None
+
+    def test_merge_hot_pixels(self):
+        # Merging the shards has to give the same result as processing every image at once
+        shards = [self.images[:2], self.images[2:]]
+        results = [hot_pixel_shard(shard, [None] * len(shard), sigma=3) for shard in shards]
+
+        self.assertEqual(set(merge_hot_pixels(results)), set(find_hps(self.images, sigma=3)))
+
+    def test_concatenate_tables(self):
+        results = [{'file': np.array(['a', 'b']), 'streak_count': np.array([1, 2])},
+                   {'file': np.array(['c']), 'streak_count': np.array([0])}]
+
+        table = concatenate_tables(results)
+        np.testing.assert_array_equal(table['file'], ['a', 'b', 'c'])
+        np.testing.assert_array_equal(table['streak_count'], [1, 2, 0])
+
+    def test_job(self):
+        with tempfile.TemporaryDirectory() as directory:
+            raw_dir, job_dir = os.path.join(directory, 'raw'), os.path.join(directory, 'job')
+            os.makedirs(raw_dir)
+
+            frames = {}
+            for index, im in enumerate(self.images):
+                file_name = os.path.join(raw_dir, "navcam_{0:04d}.img_x".format(index))
+                open(file_name, 'w').close()
+                frames[file_name] = im
+
+            # The second shard fails to load the first time the job runs. The rerun can only load the second shard,
+            # so it fails if the completed shards are processed again
+            loadable = set(sorted(frames)[:1] + sorted(frames)[2:])
+
+            def load_files(file_names):
+                if not loadable.issuperset(file_names):
+                    raise IOError("Corrupt file")
+                return SimpleNamespace(images=[frames[f] for f in file_names])
+
+            with mock.patch('archive_jobs.load_files', load_files):
+                self.assertEqual(create_job([raw_dir], job_dir, 'hot_pixels', shard_size=1, sigma=3), 4)
+
+                self.assertEqual(run_job(job_dir, processes=2), {1: "OSError: Corrupt file"})
+                self.assertTrue(os.path.exists(shard_path(job_dir, 1, 'error')))
+                with self.assertRaises(RuntimeError):
+                    merge_job(job_dir)
+
+                loadable = set(sorted(frames)[1:2])
+                self.assertEqual(run_job(job_dir, processes=2), {})
+
+            self.assertFalse(os.path.exists(shard_path(job_dir, 1, 'error')))
+            self.assertFalse([f for f in os.listdir(job_dir) if f.endswith('.lock')])
+            self.assertEqual(set(merge_job(job_dir)), set(find_hps(self.images, sigma=3)))
+
+    def test_create_empty_job(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertRaises(ValueError):
+                create_job([directory], os.path.join(directory, 'job'), 'hot_pixels')
+
+    def test_claim(self):
+        with tempfile.TemporaryDirectory() as job_dir:
+            lock = shard_path(job_dir, 0, 'lock')
+
+            # A live worker on this machine keeps its lock
+            with open(lock, 'w') as f:
+                f.write("{0} {1}".format(socket.gethostname(), os.getppid()))
+            self.assertFalse(claim(job_dir, 0, stale_after=3600))
+
+            # A worker on this machine that is gone, and a worker on another machine that hasn't updated its lock
+            for owner, age in (("{0} 999999999".format(socket.gethostname()), 0), ("other-host 1", 7200)):
+                with open(lock, 'w') as f:
+                    f.write(owner)
+                os.utime(lock, (time.time() - age, time.time() - age))
+
+                self.assertTrue(claim(job_dir, 0, stale_after=3600))
+                self.assertEqual(os.listdir(job_dir), ['shard_0.lock'])
+
+                release(job_dir, 0)
+                self.assertFalse(os.path.exists(lock))
+
+            # Releasing a lock that is already gone is fine
+            release(job_dir, 0)
+
+    def test_finished_while_claiming(self):
+        with tempfile.TemporaryDirectory() as job_dir:
+            # Another worker finishes the shard and releases its lock right before this worker claims it
+            def finish_and_claim(job_dir, shard, stale_after):
+                open(shard_path(job_dir, shard, 'npz'), 'w').close()
+                return claim(job_dir, shard, stale_after)
+
+            with mock.patch('archive_jobs.claim', finish_and_claim), mock.patch('archive_jobs.load_files') as load:
+                self.assertIsNone(run_shard(job_dir, 0))
+
+            load.assert_not_called()
+            self.assertEqual(os.listdir(job_dir), ['shard_0.npz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+from synthetic import Synthetic
+from background import fit_background, background_model, subtract_background
+from tests.test_find_hot_pixels import add_hot_pixels
+
+
+class TestBackground(unittest.TestCase):
+
+    # Create random images with stars and hot pixels on top of stray light gradients of increasing strength
+    def setUp(self):
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(972, 1296), background_mean=100, background_std=1.5, psf=psf, star_count=50)
+
+        y, x = np.mgrid[0:972, 0:1296]
+        glow = np.exp(-((x - 1296) ** 2 + y ** 2) / (2 * 600.0 ** 2))
+
+        self.strengths = [10, 20, 40]
+        self.surfaces = [100 + s * glow for s in self.strengths]
+
+        images = [synthetic.generate_image(exposure=5) - 100 + surface for surface in self.surfaces]
+        self.frames = np.array(add_hot_pixels(images, count=25))
+
+    def tearDown(self):
+        self.frames = None
+
+    def test_model_matches_surface(self):
+        model = background_model(fit_background(self.frames), self.frames.shape[-2:])
+
+        for index, surface in enumerate(self.surfaces):
+            self.assertLess(np.abs(model[index] - surface).max(), 1.5)
+
+    def test_single_image(self):
+        coefficients = fit_background(self.frames[0])
+        self.assertEqual(coefficients.shape, (4, 4))
+        np.testing.assert_allclose(coefficients, fit_background(self.frames[:1])[0])
+
+    def test_chunks(self):
+        # Binning the stack a few images at a time doesn't change the fit, and a list of images works the same
+        np.testing.assert_allclose(fit_background(list(self.frames), chunk_size=2),
+                                   fit_background(self.frames, chunk_size=len(self.frames)))
+
+    def test_coefficient_series(self):
+        # The stray light terms grow with the strength of the glow
+        coefficients = fit_background(self.frames)
+        slopes = coefficients[:, 0, 1]
+        np.testing.assert_allclose(slopes / slopes[0], np.divide(self.strengths, self.strengths[0]), rtol=0.05)
+
+    def test_subtract_background(self):
+        flat = subtract_background(list(self.frames), chunk_size=1)
+        self.assertEqual(len(flat), len(self.frames))
+        for im in flat:
+            self.assertLess(np.abs(np.median(im)), 0.5)
+
+        np.testing.assert_allclose(subtract_background(self.frames[0]), flat[0])
+
+    def test_underdetermined(self):
+        # A 100x130 image only has 6 blocks of 64 pixels, too few for the 16 coefficients of a degree 3 surface
+        with self.assertRaises(ValueError):
+            fit_background(self.frames[0, :100, :130], block=64)
+
+        self.assertEqual(fit_background(self.frames[0, :100, :130], block=64, degree=1).shape, (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
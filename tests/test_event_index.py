@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+from datetime import datetime, timedelta
+from skimage.draw import line_aa
+from synthetic import Synthetic
+from event_index import COLUMNS, EventIndex, extract_events
+
+
+class TestEventIndex(unittest.TestCase):
+
+    # Create random images with the same hot pixels in each and a streak in the last one
+    def setUp(self):
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(500, 600), background_mean=100, background_std=1.5, psf=psf, star_count=10)
+
+        # Fixed seed so that two stars never happen to touch and form a second elongated event
+        state = np.random.get_state()
+        np.random.seed(0)
+        try:
+            images = [synthetic.generate_image(exposure=5) for i in range(4)]
+        finally:
+            np.random.set_state(state)
+
+        rr, cc, val = line_aa(100, 100, 110, 140)
+        images[-1][rr, cc] += val * 500
+
+        # Keep the hot pixels away from the stars, the streak and each other. A hot pixel that touches another source
+        # joins its cluster and isn't found by persistent
+        self.hot_pixels = set()
+        while len(self.hot_pixels) < 10:
+            y, x = np.random.randint(5, 495), np.random.randint(5, 595)
+            if all(im[y - 4:y + 5, x - 4:x + 5].max() < 115 for im in images):
+                self.hot_pixels.add((y, x))
+                for im in images:
+                    im[y, x] = 2000
+
+        self.start = datetime(2017, 4, 10)
+        times = [self.start + timedelta(minutes=40 * i) for i in range(4)]
+
+        table, frame_times = extract_events(images, times)
+        self.events = EventIndex(table, frame_times, cell_size=32)
+
+    def tearDown(self):
+        self.events = None
+
+    def test_persistent(self):
+        self.assertTrue(self.hot_pixels.issubset(self.events.persistent()))
+
+    def test_near(self):
+        x, y = 300, 250
+        distance = np.hypot(self.events['x'] - x, self.events['y'] - y)
+        expected = np.where(distance <= 120)[0]
+
+        np.testing.assert_array_equal(self.events.near(x, y, 120), expected)
+
+    def test_near_outside(self):
+        # Points past the events on every side, both out of reach and close enough to reach the nearest events
+        x_max, y_max = self.events['x'].max(), self.events['y'].max()
+        for x, y in [(-500, 250), (x_max + 500, 250), (300, -500), (300, y_max + 500), (-500, -500),
+                     (x_max + 500, y_max + 500), (-50, 250), (x_max + 50, 250), (300, -50), (300, y_max + 50)]:
+            for radius in [10, 150]:
+                distance = np.hypot(self.events['x'] - x, self.events['y'] - y)
+                expected = np.where(distance <= radius)[0]
+                np.testing.assert_array_equal(self.events.near(x, y, radius), expected)
+
+    def test_near_outside_small_grid(self):
+        # Events in the corners of a 4x4 grid of cells, queried from outside of the grid on every side
+        table = {name: np.zeros(4) for name in COLUMNS}
+        table['x'], table['y'] = np.array([10, 200, 10, 200]), np.array([10, 10, 200, 200])
+        events = EventIndex(table, np.zeros(1), cell_size=64)
+
+        for x, y in [(5000, 200), (-5000, 200), (200, 5000), (200, -5000), (5000, 5000), (-5000, -5000)]:
+            np.testing.assert_array_equal(events.near(x, y, 10), [])
+
+        np.testing.assert_array_equal(events.near(230, 200, 40), [3])
+        np.testing.assert_array_equal(events.near(-20, 10, 40), [0])
+        np.testing.assert_array_equal(events.near(10, 230, 40), [2])
+        np.testing.assert_array_equal(events.near(200, -20, 40), [1])
+
+    def test_elongated_rate(self):
+        elongated = np.where(self.events['elongation'] >= 3)[0]
+        self.assertEqual(len(elongated), 1)
+        self.assertEqual(self.events['frame'][elongated[0]], 3)
+
+        starts, counts = self.events.rate(np.timedelta64(1, 'h'), events=elongated)
+        np.testing.assert_array_equal(counts, [0, 0, 1])
+
+    def test_between(self):
+        events = self.events.between(self.start, self.start + timedelta(hours=1))
+        self.assertEqual(set(self.events['frame'][events]), {0, 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
 import unittest
 import numpy as np
 from synthetic import Synthetic
-from find_streaks import find_streaks
+from find_streaks import find_streaks, StreakFilterBank
 from skimage.draw import line_aa
 
 
@@ -11,8 +11,14 @@ class TestFindStreaks(unittest.TestCase):
         # Create a fake image and add 5 streaks
         psf = np.ones((5, 5)) / 5 ** 2
         synthetic = Synthetic(shape=(1000, 1000), background_mean=100, background_std=0.0001, psf=psf, star_count=25)
-        image = synthetic.generate_image(exposure=5)
-        self.image = add_streaks(image, count=5)
+
+        # Fixed seed so that the randomly placed streaks never overlap. The global random state is left as it was
+        state = np.random.get_state()
+        np.random.seed(0)
+        try:
+            self.image = add_streaks(synthetic.generate_image(exposure=5), count=5)
+        finally:
+            np.random.set_state(state)
 
     def tearDown(self):
         self.image = None
@@ -21,6 +27,28 @@ class TestFindStreaks(unittest.TestCase):
         streak_count = find_streaks(self.image)
         self.assertEqual(streak_count, 5)
 
+    def test_find_streaks_matched(self):
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(1000, 1000), background_mean=100, background_std=0.0001, psf=psf, star_count=25)
+        image = generate_image(synthetic, exposure=5, seed=0)
+
+        # Fixed streaks of different lengths and angles that are far apart from each other
+        for start, end in [((100, 100), (100, 140)), ((300, 200), (325, 225)), ((600, 100), (640, 112)),
+                           ((800, 500), (808, 540)), ((200, 700), (230, 680))]:
+            image = draw_streak(image, start, end, 1500)
+
+        streak_count = find_streaks(image, method='matched', bank=StreakFilterBank())
+        self.assertEqual(streak_count, 5)
+
+    def test_matched_ignores_noise(self):
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(1000, 1000), background_mean=100, background_std=1.5, psf=psf, star_count=25)
+        bank = StreakFilterBank()
+
+        for seed in range(5):
+            image = generate_image(synthetic, exposure=5, seed=seed)
+            self.assertEqual(find_streaks(image, method='matched', bank=bank), 0)
+
 
 # Helper functions
 
@@ -35,6 +63,22 @@ def place_streak(image, length, value):
     return image
 
 
+def generate_image(synthetic, exposure, seed):
+    """Generate a synthetic image from a fixed seed without changing the global random state"""
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        return synthetic.generate_image(exposure=exposure)
+    finally:
+        np.random.set_state(state)
+
+
+def draw_streak(image, start, end, value):
+    rr, cc, val = line_aa(*start, *end)
+    image[rr, cc] = val * value
+    return image
+
+
 def add_streaks(image, count):
 
     streak_value = 1500
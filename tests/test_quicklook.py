@@ -0,0 +1,75 @@
+import os
+import unittest
+import tempfile
+import numpy as np
+from types import SimpleNamespace
+from unittest import mock
+from skimage import io
+from quicklook import build_pyramid, save_tiles, contact_sheet, export_pyramids, raw_2_pyramid
+
+
+class TestQuicklook(unittest.TestCase):
+
+    def test_build_pyramid(self):
+        im = np.random.uniform(0, 1000, (999, 701))
+        levels = build_pyramid(im, tile=256)
+
+        # Odd sizes lose their last row or column before each downsampling
+        self.assertEqual([level.shape for level in levels], [(999, 701), (499, 350), (249, 175)])
+
+        np.testing.assert_allclose(levels[1][10, 20], im[20:22, 40:42].mean())
+        np.testing.assert_allclose(levels[2][5, 7], im[20:24, 28:32].mean())
+
+    def test_save_tiles(self):
+        level = np.random.uniform(0, 1000, (300, 520))
+
+        with tempfile.TemporaryDirectory() as directory:
+            count = save_tiles(level, os.path.join(directory, '0'), tile=256, limits=(0, 1000))
+            names = sorted(os.listdir(os.path.join(directory, '0')))
+
+            self.assertEqual(count, 6)
+            self.assertEqual(names, ['0_0.png', '0_1.png', '0_2.png', '1_0.png', '1_1.png', '1_2.png'])
+            self.assertEqual(io.imread(os.path.join(directory, '0', '1_2.png')).shape, (44, 8))
+
+    def test_contact_sheet(self):
+        thumbnails = [np.full((10, 20), i + 1, dtype=np.uint8) for i in range(4)] + [np.full((8, 12), 5, np.uint8)]
+        sheet = contact_sheet(thumbnails, columns=2, spacing=4)
+
+        # 3 rows of 10 pixel thumbnails and 2 columns of 20 pixel thumbnails with 4 pixels between them
+        self.assertEqual(sheet.shape, (3 * 14 - 4, 2 * 24 - 4))
+        self.assertTrue((sheet[14:24, 24:44] == 4).all())
+        self.assertTrue((sheet[28:36, 0:12] == 5).all())
+        self.assertTrue((sheet[:, 20:24] == 0).all())
+
+    def test_export_pyramids(self):
+        # Raw images increase to the right. They're flipped before exporting, so the thumbnails decrease instead
+        raw = {'navcam_1234.img_x': np.tile(np.arange(600.), (400, 1)),
+               'navcam_5678.img_x': np.tile(np.arange(600.), (400, 1)) * 2}
+
+        def load_files(file_names):
+            return SimpleNamespace(images=[raw[f] for f in file_names])
+
+        with tempfile.TemporaryDirectory() as destination, mock.patch('quicklook.load_files', load_files):
+            thumbnails = export_pyramids(sorted(raw), destination, tile=256, processes=2)
+
+            self.assertEqual(sorted(os.listdir(destination)), ['1234', '5678'])
+            self.assertEqual(sorted(os.listdir(os.path.join(destination, '1234'))), ['0', '1', '2'])
+            self.assertEqual(len(os.listdir(os.path.join(destination, '1234', '0'))), 6)
+
+        self.assertEqual(len(thumbnails), 2)
+        self.assertEqual(thumbnails[0].shape, (100, 150))
+        self.assertGreater(thumbnails[0][:, 0].mean(), thumbnails[0][:, -1].mean())
+
+    def test_empty_directory(self):
+        # A directory without raw files is rejected before any worker is started or anything is written
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as destination, \
+                mock.patch('quicklook.export_pyramids') as export:
+            with self.assertRaises(ValueError):
+                raw_2_pyramid(source, destination)
+
+            export.assert_not_called()
+            self.assertEqual(os.listdir(destination), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
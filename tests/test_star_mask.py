@@ -0,0 +1,74 @@
+import unittest
+import numpy as np
+from synthetic import Synthetic
+from find_hot_pixels import find_hps
+from star_mask import StarIndex, radec_to_vectors, quaternion_to_rotation, pointing_rotation, project_stars, star_mask
+from load_tagcam import princ_point_x, princ_point_y
+
+
+class TestStarMask(unittest.TestCase):
+
+    # Create a random sky catalogue
+    def setUp(self):
+        star_count = 20000
+        ra = np.random.uniform(0, 360, star_count)
+        dec = np.degrees(np.arcsin(np.random.uniform(-1, 1, star_count)))
+        self.index = StarIndex(ra, dec, np.random.uniform(0, 9, star_count))
+
+    def tearDown(self):
+        self.index = None
+
+    def test_query_matches_brute_force(self):
+        for ra, dec in [(10, 0), (359, 45), (0.5, -30), (180, 88), (90, -89)]:
+            center = radec_to_vectors(ra, dec)[0]
+            expected = np.where(self.index.vectors @ center >= np.cos(np.radians(20)))[0]
+
+            np.testing.assert_array_equal(np.sort(self.index.query(ra, dec, 20)), expected)
+
+    def test_boresight_projects_to_principal_point(self):
+        index = StarIndex([123.4], [-56.7])
+        rows, cols, _ = project_stars(index, pointing_rotation(123.4, -56.7, roll=30))
+
+        self.assertAlmostEqual(rows[0], princ_point_y)
+        self.assertAlmostEqual(cols[0], princ_point_x)
+
+    def test_quaternion_to_rotation(self):
+        np.testing.assert_allclose(quaternion_to_rotation([1, 0, 0, 0]), np.eye(3), atol=1e-12)
+
+        # 90 degree turn of the camera about its boresight. The inertial +x axis is now along camera -y
+        angle = np.radians(90) / 2
+        rotation = quaternion_to_rotation([np.cos(angle), 0, 0, np.sin(angle)])
+        np.testing.assert_allclose(rotation @ [1, 0, 0], [0, -1, 0], atol=1e-12)
+
+        # Any quaternion, normalized or not, gives a proper rotation
+        rotation = quaternion_to_rotation([0.3, -1.2, 0.5, 2.0])
+        np.testing.assert_allclose(rotation @ rotation.T, np.eye(3), atol=1e-12)
+        self.assertAlmostEqual(np.linalg.det(rotation), 1)
+
+    def test_flip(self):
+        rotation = pointing_rotation(45, 20, roll=10)
+        mask = star_mask(self.index, rotation)
+
+        self.assertTrue(mask.any())
+        np.testing.assert_array_equal(star_mask(self.index, rotation, flip=True), np.fliplr(mask))
+
+    def test_find_hps_rejects_stars(self):
+        # Two images pointing at the same field. Point-like stars look exactly like hot pixels
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(1944, 2592), background_mean=100, background_std=1.5, psf=psf, star_count=5)
+        images = [synthetic.generate_image(exposure=5), synthetic.generate_image(exposure=10)]
+
+        rotation = pointing_rotation(200, 10)
+        rows, cols, _ = project_stars(self.index, rotation, magnitude_limit=6)
+        rows, cols = np.rint(rows).astype(int), np.rint(cols).astype(int)
+
+        for im in images:
+            im[rows, cols] = 3000
+
+        mask = star_mask(self.index, rotation, magnitude_limit=6, radius=1)
+        self.assertGreater(len(find_hps(images, sigma=3)), 0)
+        self.assertEqual(len(find_hps(images, sigma=3, star_masks=[mask, mask])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import numpy as np
+from scipy.ndimage import fourier_shift
+from synthetic import Synthetic
+from stowcam_diff import detect_change, detect_changes, HELIOCENTRIC_FACTOR
+
+
+class TestStowcamDiff(unittest.TestCase):
+
+    # Create an image, a shifted launch 14 day copy of it and darken a spot in the new image
+    def setUp(self):
+        psf = np.ones((5, 5)) / 5 ** 2
+        synthetic = Synthetic(shape=(600, 800), background_mean=100, background_std=1.5, psf=psf, star_count=25)
+
+        im_l14 = synthetic.generate_image(exposure=5)
+        self.shift = (3.4, -2.6)
+
+        im = np.fft.ifftn(fourier_shift(np.fft.fftn(im_l14), self.shift)).real
+        im += synthetic.gaussian_noise()
+        im_l14 /= HELIOCENTRIC_FACTOR
+
+        self.spot = (300, 420)
+        im[self.spot[0] - 6:self.spot[0] + 6, self.spot[1] - 6:self.spot[1] + 6] -= 40
+
+        self.im, self.im_l14 = im, im_l14
+
+    def tearDown(self):
+        self.im, self.im_l14 = None, None
+
+    def test_registration(self):
+        change = detect_change(self.im, self.im_l14)
+        np.testing.assert_allclose(change['shift'], self.shift, atol=0.1)
+
+    def test_black_spot(self):
+        regions = detect_change(self.im, self.im_l14)['regions']
+        self.assertEqual(len(regions), 1)
+
+        y, x = regions[0]['centroid']
+        self.assertAlmostEqual(y, self.spot[0] - 0.5, delta=1)
+        self.assertAlmostEqual(x, self.spot[1] - 0.5, delta=1)
+        self.assertLess(regions[0]['mean_difference'], 0)
+
+    def test_detect_changes(self):
+        # The launch 14 day images are in a different order than the new images
+        unchanged = self.im_l14 * HELIOCENTRIC_FACTOR + np.random.normal(size=self.im.shape) * 1.5
+        images, images_l14 = [self.im, unchanged], [self.im_l14.copy(), self.im_l14.copy()]
+
+        changes = detect_changes(images, images_l14, exposures=[5, 10], exposures_l14=[10, 5], processes=2)
+
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(len(changes[0]['regions']), 1)
+        np.testing.assert_allclose(changes[0]['shift'], self.shift, atol=0.1)
+        self.assertEqual(len(changes[1]['regions']), 0)
+
+    def test_detect_changes_unmatched_exposure(self):
+        with self.assertRaises(ValueError):
+            detect_changes([self.im], [self.im_l14], exposures=[5], exposures_l14=[10])
+
+
+if __name__ == '__main__':
+    unittest.main()